@@ -0,0 +1,138 @@
+import glob
+import os
+from Protocol import ProtocolError
+from Storage import validate_meta
+
+# Batch transfers: /mstore and /mget move many files with one command and no
+# round trip per file.
+#
+# A batch is a stream of entries laid out like the members of a tar archive:
+# each is a FILE_META header followed by the file's data, as one FILE_DATA
+# frame or, with a codec, as compressed frames ending in an empty one. The
+# receiver writes every file as its entry arrives.
+#
+# /mstore is the COMMAND "/mstore", then entries {filename, size, sha256,
+# chunks, codec} chosen entirely by the client, then an empty FILE_META {} to
+# end the stream. The server answers with one FILE_STATUS {batch, files, bytes,
+# errors}. /mget <pattern>... is answered with an entry {filename, size,
+# offset, length, sha256, codec, batch} for every stored file matching one of
+# the globs, and ends with FILE_STATUS {batch, files, bytes, missing}.
+
+
+# Stored names are flat, so an entry may not carry a path.
+def is_valid_filename(filename):
+    return (isinstance(filename, str) and filename == os.path.basename(filename) and filename not in ['', '..']
+            and not filename.startswith('.'))
+
+
+# Expands the arguments of /mstore into the files to upload.
+#
+# Args:
+#     patterns (list): Globs and directories; a directory stands for every
+#         file under it, skipping hidden ones.
+#
+# Returns:
+#     tuple: (paths in order, patterns that matched no file)
+def expand_paths(patterns):
+    paths = []
+    unmatched = []
+
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = []
+            for root, dirs, files in os.walk(pattern):
+                dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+                matches += [os.path.join(root, name) for name in sorted(files) if not name.startswith('.')]
+        else:
+            matches = sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+
+        if not matches:
+            unmatched.append(pattern)
+        paths += matches
+
+    return paths, unmatched
+
+
+# Writes one /mstore entry into a storage Upload.
+#
+# The client sends every entry whole, since asking which ranges the server
+# still needs would cost a round trip per file. Bytes outside the upload's
+# ranges, such as chunks a deduplicating backend already holds, are read and
+# dropped. An entry with an invalid filename gets no upload and is dropped
+# entirely. Delta uploads, which rebuild the whole file, go through here too.
+#
+# Args:
+#     storage: The storage backend.
+#     meta (dict): The entry's FILE_META.
+#     upload: An Upload already begun for the file, if any.
+class BatchEntry:
+    def __init__(self, storage, meta, upload=None):
+        validate_meta(meta)
+        self.filename = meta.get('filename')
+        self.size = meta['size']
+        if upload is None and is_valid_filename(self.filename):
+            upload = storage.begin_upload(self.filename, meta)
+        self.upload = upload
+        self.ranges = list(self.upload.ranges) if self.upload is not None else []
+        self.position = 0
+        self.range_end = None  # end of the range being written, if any
+        self.error = None
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self.range_end is None:
+                if not self.ranges:
+                    self.position += len(view)
+                    return
+
+                offset, length = self.ranges[0]
+                if self.position < offset:
+                    skipped = min(len(view), offset - self.position)
+                    view = view[skipped:]
+                    self.position += skipped
+                    continue
+
+                del self.ranges[0]
+                self.upload.start_range(offset, length)
+                self.range_end = offset + length
+
+            count = min(len(view), self.range_end - self.position)
+            self.upload.write(view[:count])
+            view = view[count:]
+            self.position += count
+
+            if self.position == self.range_end:
+                self.range_end = None
+                try:
+                    self.upload.end_range()
+                except ProtocolError as e:
+                    # A chunk that fails its hash only spoils this entry; the
+                    # rest of the stream is still framed correctly.
+                    self.error = f"Error: {e} {self.filename} was discarded."
+                    self.ranges = []
+
+    def close(self):
+        if self.upload is not None:
+            self.upload.close()
+
+    # Returns:
+    #     str: An error message for the client, or None if the file was stored.
+    def finish(self):
+        if self.upload is None:
+            return f"Error: Invalid filename {self.filename!r}; the file was skipped."
+        return self.error or self.upload.finish()
+
+
+# Formats the FILE_STATUS that ends a batch for the user.
+#
+# Returns:
+#     list: Message lines, a summary first and then any errors.
+def summarize_batch(status):
+    if status['batch'] == '/mstore':
+        lines = [f"Stored {status['files']} files ({status['bytes']} bytes)"]
+        lines += status.get('errors', [])
+    else:
+        lines = [f"Received {status['files']} files ({status['bytes']} bytes)"]
+        lines += [f"Error: No file in the server matches {pattern}." for pattern in status.get('missing', [])]
+    return lines
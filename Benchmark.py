@@ -0,0 +1,532 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from Compression import recv_compressed_data, send_compressed_data
+from Protocol import (CHUNK_SIZE, FRAME_CHAT, FRAME_FILE_META, FRAME_FILE_STATUS, FRAME_MESSAGE, ProtocolError,
+                      decode_file_meta, recv_file_data, recv_frame, send_command, send_file_data, send_file_meta)
+from Server import ENGINES
+from Storage import STORAGES
+
+OPERATIONS = ['store', 'get', 'dir', 'broadcast']
+DEFAULT_MIX = 'store=1,get=4,dir=1,broadcast=2'
+
+# Seconds to wait for the server to start accepting connections.
+STARTUP_TIMEOUT = 15
+
+# Seconds between samples of the server's memory and thread count.
+SAMPLE_INTERVAL = 0.2
+
+
+# Discards downloaded data, keeping only a byte count.
+class NullFile:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+# One simulated client. It speaks the same protocol as FileExchangeClient but
+# waits for the reply to each command before sending the next, so every
+# operation has a well-defined latency.
+#
+# Chat from other clients can arrive between any two frames; it is counted
+# and skipped while waiting for a reply.
+class BenchmarkClient:
+    def __init__(self, host, port, handle, codecs=()):
+        self.sock = socket.create_connection((host, port))
+        self.handle = handle
+        self.codecs = list(codecs)
+        self.chat_received = 0
+        self.sequence = 0
+
+    def close(self):
+        self.sock.close()
+
+    # Returns the next frame that is not chat from another client.
+    def next_reply(self):
+        while True:
+            frame = recv_frame(self.sock)
+            if frame is None:
+                raise ConnectionResetError("Server closed the connection.")
+
+            if frame[0] == FRAME_CHAT:
+                self.chat_received += 1
+                continue
+            return frame
+
+    def next_message(self):
+        frame_type, payload = self.next_reply()
+        if frame_type != FRAME_MESSAGE:
+            raise ProtocolError(f"Expected a message, got frame type {frame_type}.")
+        return payload.decode('utf-8')
+
+    # Each operation returns the number of file bytes it moved.
+
+    def register(self):
+        send_command(self.sock, f"/register {self.handle}")
+        reply = self.next_message()
+        if not reply.startswith('Welcome'):
+            raise ProtocolError(reply)
+        return 0
+
+    # Uploads data under name and waits for the server to confirm it was
+    # verified and stored.
+    def store(self, name, data):
+        sha256 = hashlib.sha256(data).hexdigest()
+        chunks = [hashlib.sha256(data[start:start + CHUNK_SIZE]).hexdigest()
+                  for start in range(0, len(data), CHUNK_SIZE)]
+
+        send_command(self.sock, f"/store {name}")
+        send_file_meta(self.sock, filename=name, size=len(data), sha256=sha256, chunks=chunks, codecs=self.codecs)
+
+        frame_type, payload = self.next_reply()
+        if frame_type != FRAME_FILE_STATUS:
+            raise ProtocolError(payload.decode('utf-8', 'replace'))
+        status = decode_file_meta(payload)
+
+        file = io.BytesIO(data)
+        sent = 0
+        for offset, length in status['ranges']:
+            if status.get('codec', 'none') != 'none':
+                send_compressed_data(self.sock, [(file, offset, length)], status['codec'])
+            else:
+                send_file_data(self.sock, file, length, offset)
+            sent += length
+
+        frame_type, payload = self.next_reply()
+        if frame_type != FRAME_FILE_STATUS:
+            raise ProtocolError(payload.decode('utf-8', 'replace'))
+        status = decode_file_meta(payload)
+        if not status.get('stored'):
+            raise ProtocolError(status.get('error'))
+        return sent
+
+    def get(self, name):
+        command = f"/get {name}"
+        if self.codecs:
+            command += f" codecs={','.join(self.codecs)}"
+        send_command(self.sock, command)
+
+        frame_type, payload = self.next_reply()
+        if frame_type != FRAME_FILE_META:
+            raise ProtocolError(payload.decode('utf-8', 'replace'))
+        meta = decode_file_meta(payload)
+
+        sink = NullFile()
+        if meta.get('codec', 'none') != 'none':
+            recv_compressed_data(self.sock, sink, meta['codec'], meta['length'])
+        else:
+            recv_file_data(self.sock, sink)
+
+        if sink.size != meta['length']:
+            raise ProtocolError(f"Received {sink.size} of {meta['length']} bytes of {name}.")
+        return sink.size
+
+    # Returns:
+    #     list: The listing's file lines.
+    def list_directory(self, *options):
+        send_command(self.sock, ' '.join(['/dir', *options]))
+
+        header = self.next_message()
+        if not header.startswith('Server Directory'):
+            raise ProtocolError(header)
+
+        # "Server Directory (page p of n, count files, lines on this page)"
+        expected = int(re.findall(r'\d+', header)[3])
+
+        lines = []
+        while len(lines) < expected:
+            lines.extend(self.next_message().split('\n'))
+        return lines
+
+    def dir(self):
+        self.list_directory()
+        return 0
+
+    def broadcast(self):
+        self.sequence += 1
+        token = f"#{self.handle}-{self.sequence}"
+        send_command(self.sock, f"/broadcast benchmark {token}")
+
+        frame_type, payload = self.next_reply()
+        if frame_type != FRAME_MESSAGE or not payload.decode('utf-8', 'replace').endswith(token):
+            raise ProtocolError("Broadcast was not echoed back.")
+        return 0
+
+
+# Tracks the memory and thread count of the server process from /proc, where
+# available. On other platforms the samples stay empty.
+class ProcessSampler:
+    def __init__(self, pid):
+        self.pid = pid
+        self.rss = []
+        self.threads = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='process-sampler', daemon=True)
+
+    # Adds up the server and its child processes, so a server started with
+    # --workers is measured as a whole.
+    def sample(self):
+        rss = threads = 0
+        for pid in self.process_tree(self.pid):
+            try:
+                with open(f"/proc/{pid}/status") as file:
+                    for line in file:
+                        if line.startswith('VmRSS:'):
+                            rss += int(line.split()[1]) * 1024
+                        elif line.startswith('Threads:'):
+                            threads += int(line.split()[1])
+            except OSError:
+                pass
+
+        if rss:
+            self.rss.append(rss)
+            self.threads.append(threads)
+
+    def process_tree(self, pid):
+        pids = [pid]
+        try:
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as file:
+                    for child in file.read().split():
+                        pids += self.process_tree(int(child))
+        except OSError:
+            pass
+        return pids
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+    def results(self):
+        if not self.rss:
+            return {'peak_rss_mb': None, 'final_rss_mb': None, 'peak_threads': None, 'final_threads': None}
+        return {
+            'peak_rss_mb': round(max(self.rss) / 1e6, 1),
+            'final_rss_mb': round(self.rss[-1] / 1e6, 1),
+            'peak_threads': max(self.threads),
+            'final_threads': self.threads[-1],
+        }
+
+
+# Nearest-rank percentile of a sorted list.
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        operation, _, weight = item.partition('=')
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {operation!r}, expected one of {OPERATIONS}")
+        mix[operation] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("The mix needs at least one operation with a positive weight.")
+    return mix
+
+
+# Starts a local server, runs the simulated clients against it and collects
+# the results.
+#
+# Attributes:
+#     options (argparse.Namespace): The benchmark settings, see main().
+#     latencies (dict): operation -> list of latencies in seconds.
+#     errors (dict): operation -> number of failed operations.
+#     transferred (dict): operation -> file bytes moved.
+class Benchmark:
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.latencies = {operation: [] for operation in ['register', *OPERATIONS]}
+        self.errors = {operation: 0 for operation in self.latencies}
+        self.error_messages = []
+        self.transferred = {operation: 0 for operation in self.latencies}
+        self.chat_received = 0
+        self.payload = random.Random(options.seed).randbytes(options.file_size)
+        self.shared_files = [f"bench-shared-{index}" for index in range(options.files)]
+
+    def start_server(self):
+        self.work_path = tempfile.mkdtemp(prefix='fileexchange-bench-')
+        server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Server.py')
+        command = [sys.executable, server_path, '--host', self.options.host, '--port', str(self.options.port),
+                   '--engine', self.options.engine, '--storage', self.options.storage, *self.options.server_option]
+
+        self.server = subprocess.Popen(command, cwd=self.work_path, stdout=subprocess.DEVNULL)
+
+        deadline = time.time() + STARTUP_TIMEOUT
+        while True:
+            try:
+                socket.create_connection((self.options.host, self.options.port)).close()
+                return
+            except OSError:
+                if self.server.poll() is not None or time.time() > deadline:
+                    self.stop_server()
+                    raise RuntimeError("The server did not start.")
+                time.sleep(0.1)
+
+    def stop_server(self):
+        self.server.terminate()
+        try:
+            self.server.wait(5)
+        except subprocess.TimeoutExpired:
+            self.server.kill()
+            self.server.wait()
+
+        if not self.options.keep_files:
+            shutil.rmtree(self.work_path, ignore_errors=True)
+
+    # Gives every file a unique first 16 bytes, so no two uploads share content
+    # and the storage backend cannot skip them.
+    def make_file(self, label):
+        return label.encode('utf-8')[:16].ljust(16, b'\0') + self.payload[16:]
+
+    def record(self, operation, started, size=0, error=None):
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            if error is None:
+                self.latencies[operation].append(elapsed)
+                self.transferred[operation] += size
+            else:
+                self.errors[operation] += 1
+                if len(self.error_messages) < 10:
+                    self.error_messages.append(f"{operation}: {error}")
+
+    def upload_shared_files(self):
+        client = BenchmarkClient(self.options.host, self.options.port, 'bench-setup', self.options.codecs)
+        try:
+            client.register()
+            for name in self.shared_files:
+                client.store(name, self.make_file(name))
+        finally:
+            client.close()
+
+    def run_client(self, index, start_barrier, deadline):
+        rng = random.Random(self.options.seed + index)
+        operations = list(self.options.mix)
+        weights = [self.options.mix[operation] for operation in operations]
+        client = None
+
+        try:
+            started = time.perf_counter()
+            try:
+                client = BenchmarkClient(self.options.host, self.options.port, f"bench{index}", self.options.codecs)
+                client.register()
+                self.record('register', started)
+            except (OSError, ProtocolError) as e:
+                self.record('register', started, error=e)
+                return
+            finally:
+                start_barrier.wait()
+
+            while time.time() < deadline[0]:
+                operation = rng.choices(operations, weights)[0]
+                started = time.perf_counter()
+                try:
+                    if operation == 'store':
+                        name = f"bench{index}-{client.sequence}"
+                        client.sequence += 1
+                        size = client.store(name, self.make_file(name))
+                    elif operation == 'get':
+                        size = client.get(rng.choice(self.shared_files))
+                    elif operation == 'dir':
+                        size = client.dir()
+                    else:
+                        size = client.broadcast()
+                    self.record(operation, started, size)
+
+                except ProtocolError as e:
+                    # The server answered with an error; the connection is still usable
+                    self.record(operation, started, error=e)
+
+                except OSError as e:
+                    self.record(operation, started, error=e)
+                    return
+
+        finally:
+            if client is not None:
+                with self.lock:
+                    self.chat_received += client.chat_received
+                client.close()
+
+    def run(self):
+        self.start_server()
+        try:
+            sampler = ProcessSampler(self.server.pid)
+            sampler.start()
+
+            if 'get' in self.options.mix:
+                self.upload_shared_files()
+
+            # Every client registers before the clock starts
+            deadline = [float('inf')]
+            start_barrier = threading.Barrier(self.options.clients + 1)
+            threads = [threading.Thread(target=self.run_client, args=(index, start_barrier, deadline), daemon=True)
+                       for index in range(self.options.clients)]
+            for thread in threads:
+                thread.start()
+
+            start_barrier.wait()
+            start = time.time()
+            deadline[0] = start + self.options.duration
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+
+            sampler.stop()
+        finally:
+            self.stop_server()
+
+        return self.results(elapsed, sampler)
+
+    def results(self, elapsed, sampler):
+        operations = {}
+        total_ops = total_bytes = 0
+
+        for operation, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            count = len(latencies)
+            if not count and not self.errors[operation]:
+                continue
+
+            # Registration happens before the clock starts, so it has no rate
+            measured = operation != 'register'
+            if measured:
+                total_ops += count
+                total_bytes += self.transferred[operation]
+
+            operations[operation] = {
+                'count': count,
+                'errors': self.errors[operation],
+                'ops_per_s': round(count / elapsed, 2) if measured else None,
+                'mb_per_s': round(self.transferred[operation] / elapsed / 1e6, 2) if measured else None,
+                'latency_ms': {
+                    'mean': round(sum(latencies) / count * 1000, 3) if count else None,
+                    **{name: round(percentile(latencies, fraction) * 1000, 3) if count else None
+                       for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]},
+                    'max': round(latencies[-1] * 1000, 3) if count else None,
+                },
+            }
+
+        return {
+            'config': {
+                'engine': self.options.engine,
+                'storage': self.options.storage,
+                'clients': self.options.clients,
+                'duration': self.options.duration,
+                'mix': self.options.mix,
+                'file_size': self.options.file_size,
+                'files': self.options.files,
+                'codecs': self.options.codecs,
+                'server_options': self.options.server_option,
+                'seed': self.options.seed,
+            },
+            'elapsed': round(elapsed, 3),
+            'total': {
+                'ops': total_ops,
+                'ops_per_s': round(total_ops / elapsed, 2),
+                'mb_per_s': round(total_bytes / elapsed / 1e6, 2),
+                'errors': sum(self.errors.values()),
+                'chat_received': self.chat_received,
+            },
+            'operations': operations,
+            'server': sampler.results(),
+            'error_samples': self.error_messages,
+        }
+
+
+# Compares a run against an earlier one.
+#
+# Args:
+#     results (dict): This run's results.
+#     baseline (dict): Results of the run to compare against.
+#     tolerance (float): Allowed relative loss of throughput or increase in
+#         p99 latency before an operation counts as a regression.
+#
+# Returns:
+#     list: A line describing each regression.
+def compare_results(results, baseline, tolerance):
+    regressions = []
+
+    for operation, current in results['operations'].items():
+        previous = baseline.get('operations', {}).get(operation)
+        if not previous:
+            continue
+
+        if current['ops_per_s'] and previous['ops_per_s'] and \
+                current['ops_per_s'] < previous['ops_per_s'] * (1 - tolerance):
+            regressions.append(f"{operation}: {current['ops_per_s']} ops/s, was {previous['ops_per_s']}")
+
+        current_p99, previous_p99 = current['latency_ms']['p99'], previous['latency_ms']['p99']
+        if current_p99 and previous_p99 and current_p99 > previous_p99 * (1 + tolerance):
+            regressions.append(f"{operation}: p99 {current_p99} ms, was {previous_p99} ms")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless load generator and benchmark for the File Exchange Server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12399)
+    parser.add_argument('--engine', choices=ENGINES, default='threaded')
+    parser.add_argument('--storage', choices=STORAGES, default='plain')
+    parser.add_argument('--clients', type=int, default=10, help="Number of concurrent simulated clients")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to run the mix for")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"Relative weights of {', '.join(OPERATIONS)} (default {DEFAULT_MIX})")
+    parser.add_argument('--file-size', type=int, default=1024 * 1024, help="Bytes per stored or fetched file")
+    parser.add_argument('--files', type=int, default=8, help="Number of shared files that /get picks from")
+    parser.add_argument('--codecs', type=lambda value: [codec for codec in value.split(',') if codec], default=[],
+                        help="Codecs to offer for /store and /get, e.g. zlib (default: no compression)")
+    parser.add_argument('--server-option', action='append', default=[],
+                        help="Extra argument for Server.py, e.g. --server-option=--cache-mb=256 (repeatable)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="Write the JSON results here instead of to stdout")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Relative slowdown against --baseline that counts as a regression")
+    parser.add_argument('--keep-files', action='store_true', help="Keep the server's working directory")
+    options = parser.parse_args()
+
+    results = Benchmark(options).run()
+
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if options.baseline:
+        with open(options.baseline) as file:
+            regressions = compare_results(results, json.load(file), options.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
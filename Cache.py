@@ -0,0 +1,115 @@
+import io
+import threading
+from collections import OrderedDict, namedtuple
+
+CacheEntry = namedtuple('CacheEntry', ['key', 'data'])
+
+
+# In-memory cache of whole files for /get, bounded by total bytes with LRU
+# eviction.
+#
+# Entries are keyed by filename and tagged with the file's IndexEntry, so an
+# upload or rescan that changes the file makes the cached copy a miss even
+# before the server invalidates it explicitly. When many clients ask for the
+# same uncached file at once only the first one reads it from storage; the
+# rest wait for that read instead of starting their own.
+#
+# Attributes:
+#     max_bytes (int): Total size of cached data.
+#     max_file_size (int): Larger files are always served from storage.
+class FileCache:
+    def __init__(self, max_bytes, max_file_size=None):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_bytes // 4 if max_file_size is None else min(max_file_size, max_bytes)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # filename -> CacheEntry, least recently used first
+        self.loading = {}  # (filename, key) -> threading.Event set once the load is done
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns a file's contents, reading them with loader on a miss.
+    #
+    # Args:
+    #     name (str): The filename.
+    #     key: The file's current IndexEntry; a cached copy with another key
+    #         is stale.
+    #     loader (callable): Returns the file's contents, or None if they
+    #         cannot be cached.
+    #
+    # Returns:
+    #     bytes: The contents, or None if the caller should use storage.
+    def get_or_load(self, name, key, loader):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry.key == key:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return entry.data
+
+            self.misses += 1
+            loading = self.loading.get((name, key))
+            if loading is None:
+                loading = self.loading[(name, key)] = threading.Event()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            loading.wait()
+            with self.lock:
+                entry = self.entries.get(name)
+                return entry.data if entry is not None and entry.key == key else None
+
+        try:
+            data = loader()
+            if data is not None:
+                self.put(name, key, data)
+            return data
+        finally:
+            with self.lock:
+                del self.loading[(name, key)]
+            loading.set()
+
+    def put(self, name, key, data):
+        if len(data) > self.max_file_size:
+            return
+
+        with self.lock:
+            self.discard(name)
+            self.entries[name] = CacheEntry(key, data)
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.data)
+                self.evictions += 1
+
+    def invalidate(self, name):
+        with self.lock:
+            self.discard(name)
+
+    # Must be called with the lock held.
+    def discard(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.size -= len(entry.data)
+
+
+# A Download served from a cached copy of the file.
+class CachedDownload:
+    def __init__(self, data, sha256):
+        self.data = data
+        self.size = len(data)
+        self.sha256 = sha256
+
+    def segments(self, offset, length):
+        yield io.BytesIO(self.data), offset, length
+
+    # The bytes of a range, without copying.
+    def view(self, offset, length):
+        return memoryview(self.data)[offset:offset + length]
+
+    def close(self):
+        pass
@@ -1,9 +1,51 @@
+import argparse
+import os
+import re
 import socket
+import sys
 import threading
+from collections import deque
 from datetime import datetime
-import tkinter as tk
-import tkinter.scrolledtext as tkst
-from queue import Queue
+import hashlib
+import io
+import mmap
+import time
+from queue import Empty, Queue
+from Batch import expand_paths, summarize_batch
+from Delta import DELTA_MIN_SIZE, send_delta
+from Compression import (CODECS, choose_codec, compress_frames, is_compressible, read_sample, recv_compressed_data,
+                         send_compressed_data)
+from Protocol import (BUFFER_SIZE, FRAME_CHAT, FRAME_FILE_META, FRAME_FILE_STATUS, FRAME_MESSAGE, ProtocolError,
+                      decode_file_meta, encode_file_data_header, encode_file_meta, hash_file, hash_file_chunks,
+                      recv_frame, recv_file_data, send_command, send_file_data, send_file_meta)
+
+# Seconds to wait for the server to answer an upload's metadata.
+FILE_STATUS_TIMEOUT = 30
+
+# Defaults for /pget parallel downloads.
+PARALLEL_CONNECTIONS = 4
+PARALLEL_CHUNK_SIZE = 8 * 1024 * 1024
+CHUNK_RETRIES = 3
+
+# Codecs offered to the server for /store and /get until changed with /compress.
+DEFAULT_CODECS = ['zlib']
+
+# Requests the headless client may have in flight before it waits for replies.
+PIPELINE_WINDOW = 32
+
+# Commands the client handles itself, without a reply from the server.
+LOCAL_COMMANDS = ['/compress', '/pget']
+
+# Scrollback kept by the GUI, messages it moves from message_queue to the text
+# area per pass of its pump, and milliseconds between checks for new messages.
+MAX_SCROLLBACK_LINES = 5000
+MESSAGE_BATCH = 500
+MESSAGE_POLL_INTERVAL = 50
+
+# tkinter is only imported once a FileExchangeGUI is created, so the headless
+# client starts quickly and runs without a display.
+tk = None
+tkst = None
 
 
 # Represents a client for file exchange with a server.
@@ -28,7 +70,17 @@ class FileExchangeClient:
         self.is_left = False
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.message_queue = Queue()
-        self.update_event = threading.Event()
+        self.file_status_queue = Queue()  # FILE_STATUS replies, handed from receive_data to send_file
+        self.codecs = list(DEFAULT_CODECS)
+        self.background_threads = []  # /pget downloads
+        self.update_event = threading.Event()  # set while message_queue has messages the GUI has not picked up
+
+    # Reports a message to the user: on stdout, and through message_queue to
+    # the GUI, which clears update_event when it drains the queue.
+    def notify(self, message):
+        print(message)
+        self.message_queue.put(message)
+        self.update_event.set()
 
     # Checks if the given input is a valid command.
     #
@@ -41,79 +93,175 @@ class FileExchangeClient:
 
         command, *args = input.split()
 
-        if (command in ['/leave', '/dir', '/?'] and len(args) == 0) or (
-                command in ['/register', '/store', '/get'] and len(args) == 1) or (
-                command == '/join' and len(args) == 2) or (command in ['/broadcast', '/message']):
+        if (command in ['/leave', '/?'] and len(args) == 0) or (
+                command in ['/register', '/store', '/compress'] and len(args) == 1) or (
+                command == '/get' and 1 <= len(args) <= 4) or (command == '/pget' and 1 <= len(args) <= 3) or (
+                command == '/join' and len(args) == 2) or (command == '/stats' and len(args) <= 1) or (
+                command in ['/mstore', '/mget'] and len(args) >= 1) or (
+                command in ['/dir', '/broadcast', '/message']):
             return True
 
-        elif (command in ['/leave', '/dir', '/?'] and len(args) != 0) or (
-                command in ['/register', '/store', '/get'] and len(args) != 1) or (
-                command == '/join' and len(args) != 2):
-            print("Error: Command parameters do not match or is not allowed.")
-            self.message_queue.put("Error: Command parameters do not match or is not allowed.")
+        elif (command in ['/leave', '/?'] and len(args) != 0) or (
+                command in ['/register', '/store', '/compress'] and len(args) != 1) or (
+                command == '/get' and not 1 <= len(args) <= 4) or (
+                command == '/pget' and not 1 <= len(args) <= 3) or (
+                command == '/join' and len(args) != 2) or (command == '/stats' and len(args) > 1) or (
+                command in ['/mstore', '/mget'] and len(args) == 0):
+            self.notify("Error: Command parameters do not match or is not allowed.")
             return False
 
         else:
-            print('Error: Command not found.')
-            self.message_queue.put('Error: Command not found.')
+            self.notify('Error: Command not found.')
             return False
 
     # Sends a command to the server.
     #
     # Args:
     #     command (str): The command to send.
+    #
+    # Returns:
+    #     bool: True if the command went to the server, False if it was
+    #     rejected, failed before anything was sent or is handled locally.
     def send_command(self, command):
         if self.is_command(command):
             if not self.is_connected:
-                print("Error: Connection to the server lost. Please reconnect.")
-                self.message_queue.put("Error: Connection to the server lost. Please reconnect.")
-                return
+                self.notify("Error: Connection to the server lost. Please reconnect.")
+                return False
 
             try:
-                self.client_socket.send(command.encode('utf-8'))
-
                 if command.startswith('/store'):
                     filename = command.split()[1]
-                    self.send_file(filename)
+                    return self.send_file(filename)
+
+                elif command.startswith('/mstore'):
+                    return self.send_batch(command.split()[1:])
+
+                elif command.startswith('/mget'):
+                    if self.codecs and 'codecs=' not in command:
+                        command += f" codecs={','.join(self.codecs)}"
+                    send_command(self.client_socket, command)
+
+                elif command.startswith('/get'):
+                    filename = command.split()[1]
+                    partial_path = filename + '.part'
+                    if len(command.split()) == 2 and os.path.exists(partial_path):
+                        # Resume an interrupted download from the end of its
+                        # partial file. The server starts over if the file
+                        # is now shorter than that.
+                        command = f"/get {filename} resume={os.path.getsize(partial_path)}"
+                    if self.codecs and 'codecs=' not in command:
+                        command += f" codecs={','.join(self.codecs)}"
+                    send_command(self.client_socket, command)
+
+                elif command.startswith('/compress'):
+                    self.set_codecs(command.split()[1])
+                    return False
+
+                elif command.startswith('/pget'):
+                    # Runs on its own connections, so don't hold up the caller
+                    filename, *options = command.split()[1:]
+                    options = [int(option) for option in options]
+                    thread = threading.Thread(target=self.parallel_download, args=(filename, *options), daemon=True)
+                    thread.start()
+                    self.background_threads.append(thread)
+                    return False
+
+                else:
+                    send_command(self.client_socket, command)
+                return True
+
             except ConnectionResetError:
-                print("Connection to the server lost.")
-                self.message_queue.put("Connection to the server lost.")
+                self.notify("Connection to the server lost.")
                 self.is_connected = False
 
+            except ValueError:
+                self.notify("Error: Usage is /pget <filename> [<connections> [<chunk_size>]].")
+
+        return False
+
+    # Sets the codecs offered to the server, most preferred first.
+    #
+    # Args:
+    #     value (str): A comma-separated list such as "zlib,lzma", or "none"
+    #         to turn compression off.
+    def set_codecs(self, value):
+        codecs = [codec for codec in value.split(',') if codec != 'none']
+        if not all(codec in CODECS for codec in codecs):
+            self.notify(f"Error: Usage is /compress <codec>[,<codec>...] with codecs from {', '.join(CODECS)}.")
+            return
+
+        self.codecs = codecs
+        self.notify(f"Compression: {', '.join(codecs) if codecs else 'off'}")
+
+    # Describes how much compression saved on a transfer.
+    #
+    # Args:
+    #     codec (str): The codec the transfer used.
+    #     size (int): Bytes of file data transferred.
+    #     wire (int): Bytes that actually crossed the connection.
+    #     start (float): time.time() when the transfer started.
+    #
+    # Returns:
+    #     str: A suffix for the transfer's status line, empty if uncompressed.
+    def compression_summary(self, codec, size, wire, start):
+        if codec == 'none' or not size:
+            return ''
+
+        elapsed = max(time.time() - start, 1e-6)
+        return f" ({codec}: {wire} bytes on the wire, {wire / size:.1%} of {size}, {size / elapsed / 1e6:.1f} MB/s effective)"
+
     # Receives data from the server.
     def receive_data(self):
         while True:
             try:
-                data = self.client_socket.recv(1024).decode('utf-8')
+                frame = recv_frame(self.client_socket)
 
-                if not data:
-                    print("Connection to the server lost.")
-                    self.message_queue.put("Connection to the server lost.")
+                if frame is None:
+                    self.notify("Connection to the server lost.")
                     self.is_connected = False
                     self.client_socket.close()
                     break
 
+                frame_type, payload = frame
+
+                if frame_type == FRAME_FILE_META:
+                    self.receive_file(decode_file_meta(payload))
+                    continue
+
+                if frame_type == FRAME_FILE_STATUS:
+                    status = decode_file_meta(payload)
+                    if 'batch' in status:
+                        for line in summarize_batch(status):
+                            self.notify(line)
+                    elif 'stored' not in status:
+                        self.file_status_queue.put(status)
+                    elif not status['stored']:
+                        self.notify(status['error'])
+                    continue
+
+                if frame_type == FRAME_CHAT:
+                    self.notify(payload.decode('utf-8'))
+                    continue
+
+                if frame_type != FRAME_MESSAGE:
+                    continue
+
+                data = payload.decode('utf-8')
+
                 if data.startswith('Welcome') and self.handle == "":
-                    print(data)
-                    self.message_queue.put(data)
+                    self.notify(data)
                     self.handle = data.split()[1]
                     self.handle = self.handle[:-1]
 
                 elif data.startswith('Connection closed.'):
-                    print(data)
-                    self.message_queue.put(data)
+                    self.notify(data)
                     self.is_left = True
                     print(self.is_left)
                     self.client_socket.close()
                     break
 
-                elif not data.startswith('File received from Server:'):
-                    print(data)
-                    self.message_queue.put(data)
-
                 else:
-                    filename = data.split()[4]
-                    self.receive_file(filename)
+                    self.notify(data)
 
             except ConnectionResetError:
                 print("Connection to the server lost.")
@@ -124,76 +272,586 @@ class FileExchangeClient:
                 self.client_socket.close()
                 break
 
-            except UnicodeDecodeError:
-                print("Error: Invalid input received from the server.")
-                self.message_queue.put("Error: Invalid data received from the server.")
+            except (UnicodeDecodeError, ProtocolError):
+                self.notify("Error: Invalid data received from the server.")
                 break
 
 
     # Sends a file to the server.
     #
+    # The server answers the file's metadata with the byte ranges it still
+    # needs. Whatever it already holds, from an earlier interrupted upload or
+    # as chunks shared with other files, is not sent again.
+    #
     # Args:
     #     filename (str): The name of the file to send.
+    #
+    # Returns:
+    #     bool: True if the upload was sent; the server confirms it with a
+    #     final FILE_STATUS.
     def send_file(self, filename):
         try:
             with open(filename, 'rb') as file:
-                self.client_socket.send(f"/store {filename}".encode('utf-8'))  # Start of file transmission
-
-                file_data = file.read(1024)
-                while file_data:
-                    self.client_socket.send(file_data)
-                    file_data = file.read(1024)
+                size = os.fstat(file.fileno()).st_size
+                sha256, chunks = hash_file_chunks(filename)
 
-                # Add an end-of-file marker
-                self.client_socket.send(b'<<EOF>>')
+                # Only offer compression for data that looks like it will shrink
+                codecs = []
+                if choose_codec(filename, self.codecs) != 'none' and is_compressible(read_sample([(file, 0, size)])):
+                    codecs = self.codecs
 
-            file.close()
+                # The file is stored under its base name, as with /mstore.
+                # Large files may be sent as a delta against the server's copy
+                name = os.path.basename(filename)
+                send_command(self.client_socket, f"/store {name}")  # Start of file transmission
+                send_file_meta(self.client_socket, filename=name, size=size, sha256=sha256, chunks=chunks,
+                               codecs=codecs, delta=size >= DELTA_MIN_SIZE)
 
-            print(f"{self.handle}<{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}>: Uploaded {filename}")
-            self.message_queue.put(
-                f"{self.handle}<{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}>: Uploaded {filename}")
+                try:
+                    status = self.file_status_queue.get(timeout=FILE_STATUS_TIMEOUT)
+                except Empty:
+                    self.notify("Error: The server did not respond to the upload.")
+                    return True
+
+                if 'error' in status:
+                    return True  # turned down; the FILE_STATUS that follows says why
+
+                if status.get('delta'):
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        wire, literal = send_delta(self.client_socket, data, status['delta'])
+                    if literal < size:
+                        self.notify(f"Sent {literal} of {size} bytes of {filename}; the rest matched the server's copy")
+                    self.notify(f"{self.handle}<{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}>: Uploaded {filename}")
+                    return True
+
+                ranges = status['ranges']
+                codec = status.get('codec', 'none')
+                start = time.time()
+                wire = 0
+
+                for offset, length in ranges:
+                    if codec != 'none':
+                        wire += send_compressed_data(self.client_socket, [(file, offset, length)], codec)
+                    else:
+                        send_file_data(self.client_socket, file, length, offset)
+
+            sent = sum(length for _, length in ranges)
+            summary = self.compression_summary(codec, sent, wire, start)
+            skipped = size - sent
+            if skipped:
+                self.notify(f"Server already had {skipped} of {size} bytes of {filename}")
+
+            self.notify(f"{self.handle}<{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}>: Uploaded {filename}{summary}")
+            return True
 
         except FileNotFoundError:
-            print('Error: File not found.')
-            self.message_queue.put('Error: File not found.')
+            self.notify('Error: File not found.')
+            return False
+
+    # Sends many files to the server as one /mstore batch.
+    #
+    # Entries are written back to back without waiting for the server, so
+    # small files are limited by bandwidth rather than by round trips: the
+    # metadata and data of small files are collected in a buffer that goes out
+    # with one send per BUFFER_SIZE, and larger files still use sendfile. Each
+    # file is stored under its base name; the server reports the result of the
+    # whole batch in one FILE_STATUS.
+    #
+    # Args:
+    #     patterns (list): Files, globs and directories to upload.
+    #
+    # Returns:
+    #     bool: True if the batch was sent.
+    def send_batch(self, patterns):
+        paths, unmatched = expand_paths(patterns)
+        for pattern in unmatched:
+            self.notify(f"Error: No files match {pattern}.")
+
+        entries = {}
+        for path in paths:
+            name = os.path.basename(path)
+            if name in entries:
+                self.notify(f"Error: Skipped {path}; {entries[name]} is already uploaded as {name}.")
+            else:
+                entries[name] = path
+
+        if not entries:
+            return False
+
+        send_command(self.client_socket, '/mstore')
+        buffer = bytearray()
+
+        for name, path in entries.items():
+            try:
+                file = open(path, 'rb')
+            except OSError as e:
+                self.notify(f"Error: Skipped {path}: {e.strerror}.")
+                continue
+
+            with file:
+                size = os.fstat(file.fileno()).st_size
+                sha256, chunks = hash_file_chunks(path)
+
+                codec = choose_codec(name, self.codecs)
+                if codec != 'none' and not is_compressible(read_sample([(file, 0, size)])):
+                    codec = 'none'
+
+                buffer += encode_file_meta(filename=name, size=size, sha256=sha256, chunks=chunks, codec=codec)
+
+                if codec != 'none':
+                    for frame in compress_frames([(file, 0, size)], codec):
+                        buffer += frame
+                        if len(buffer) >= BUFFER_SIZE:
+                            self.client_socket.sendall(buffer)
+                            buffer.clear()
+
+                elif size <= BUFFER_SIZE:
+                    file.seek(0)
+                    data = file.read(size)
+                    if len(data) != size:
+                        raise ProtocolError("File shrank while it was being sent.")
+                    buffer += encode_file_data_header(size) + data
+
+                else:
+                    self.client_socket.sendall(buffer)
+                    buffer.clear()
+                    send_file_data(self.client_socket, file, size)
+
+            if len(buffer) >= BUFFER_SIZE:
+                self.client_socket.sendall(buffer)
+                buffer.clear()
+
+        # An empty FILE_META ends the batch
+        buffer += encode_file_meta()
+        self.client_socket.sendall(buffer)
+        return True
 
     # Receives a file from the server.
     #
+    # A whole-file download, or one that continues an existing <filename>.part,
+    # is written to the partial file and only renamed to <filename> once its
+    # sha256 matches the server's. Any other byte range is written to
+    # <filename>.<start>-<end>.
+    #
     # Args:
-    #     filename (str): The name of the file to receive.
-    def receive_file(self, filename):
+    #     meta (dict): The FILE_META sent by the server.
+    #
+    # Returns:
+    #     bool: True if the file was received intact.
+    def receive_file(self, meta):
+        filename = meta['filename']
+        partial_path = filename + '.part'
+        offset, length, size = meta['offset'], meta['length'], meta['size']
+        codec = meta.get('codec', 'none')
+        start = time.time()
+
+        # Returns the bytes received on the wire for the compression summary
+        def receive(file, digest=None):
+            if codec != 'none':
+                return recv_compressed_data(self.client_socket, file, codec, length, digest)
+            return recv_file_data(self.client_socket, file, digest)
+
         try:
-            with open(filename, 'wb') as file:
-                while True:
-                    file_data = self.client_socket.recv(1024)
+            if offset + length == size and (offset == 0 or (
+                    os.path.exists(partial_path) and os.path.getsize(partial_path) == offset)):
+                digest = hash_file(partial_path, offset) if offset else hashlib.sha256()
 
-                    # Check for end-of-file marker
-                    if b'<<EOF>>' in file_data:
-                        file.write(file_data[:-len(b'<<EOF>>')])
-                        break
+                with open(partial_path, 'ab' if offset else 'wb') as file:
+                    wire = receive(file, digest)
+
+                if digest.hexdigest() != meta['sha256']:
+                    os.remove(partial_path)
+                    self.notify(f"Error: Checksum mismatch for {filename}; the download was discarded.")
+                    return False
 
-                    file.write(file_data)
+                os.replace(partial_path, filename)
 
-            print(f"File received: {filename}")
-            self.message_queue.put(f"File received: {filename}")
+                # Files of an /mget are summed up once the batch ends
+                if not meta.get('batch'):
+                    summary = self.compression_summary(codec, length, wire, start)
+                    self.notify(f"File received: {filename}{summary}")
+
+            else:
+                # Never into <filename>, which may be an unrelated local file
+                range_path = f"{filename}.{offset}-{offset + length}"
+                with open(range_path, 'wb') as file:
+                    wire = receive(file)
+
+                summary = self.compression_summary(codec, length, wire, start)
+                self.notify(f"File received: {range_path} (bytes {offset}-{offset + length} of {size}){summary}")
+
+            return True
 
         except ConnectionResetError:
-            print("Connection to the server lost.")
-            self.message_queue.put("Connection to the server lost.")
+            self.notify("Connection to the server lost.")
 
         except Exception as e:
-            print(f"Error receiving file: {str(e)}")
-            self.message_queue.put(f"Error receiving file: {str(e)}")
+            self.notify(f"Error receiving file: {str(e)}")
+
+        return False
+
+    # Downloads a file over several connections at once.
+    #
+    # The file is split into chunk_size ranges that a pool of data connections
+    # fetch with ranged /get requests. Each connection writes its ranges
+    # straight to their offsets in <filename>.part through its own file handle,
+    # and a range that fails is put back in the queue and retried on a fresh
+    # connection. The finished file is checked against the server's sha256
+    # before it is renamed into place.
+    #
+    # Args:
+    #     filename (str): The file to download.
+    #     connections (int): Number of data connections to open.
+    #     chunk_size (int): Size in bytes of each range.
+    #
+    # Returns:
+    #     bool: True if the file was received.
+    def parallel_download(self, filename, connections=PARALLEL_CONNECTIONS, chunk_size=PARALLEL_CHUNK_SIZE):
+        partial_path = filename + '.part'
+        start = time.time()
+
+        try:
+            with socket.create_connection((self.server_ip_add, self.port)) as sock:
+                meta = self.fetch_range(sock, filename, 0, 0, io.BytesIO())
+        except (OSError, ProtocolError) as e:
+            self.notify(f"Error: {e}")
+            return False
+
+        size = meta['size']
+        chunk_size = max(1, chunk_size)
+        with open(partial_path, 'wb') as file:
+            file.truncate(size)
+
+        chunks = Queue()
+        for offset in range(0, size, chunk_size):
+            chunks.put((offset, min(chunk_size, size - offset), 0))
+
+        failures = []
+        workers = [threading.Thread(target=self.download_chunks, args=(filename, partial_path, chunks, failures))
+                   for _ in range(max(1, min(connections, chunks.qsize())))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        if failures:
+            os.remove(partial_path)
+            self.notify(f"Error: Parallel download of {filename} failed: {failures[0]}")
+            return False
+
+        if hash_file(partial_path).hexdigest() != meta['sha256']:
+            os.remove(partial_path)
+            self.notify(f"Error: Checksum mismatch for {filename}; the download was discarded.")
+            return False
+
+        os.replace(partial_path, filename)
+
+        elapsed = max(time.time() - start, 1e-6)
+        summary = f"File received: {filename} over {len(workers)} connections ({size / elapsed / 1e6:.1f} MB/s)"
+        self.notify(summary)
+        return True
+
+    # Worker loop for parallel_download: fetches ranges from the queue until it
+    # is empty, reconnecting after any failure.
+    def download_chunks(self, filename, partial_path, chunks, failures):
+        sock = None
+
+        with open(partial_path, 'r+b') as file:
+            while not failures:
+                try:
+                    offset, length, attempts = chunks.get_nowait()
+                except Empty:
+                    break
+
+                try:
+                    if sock is None:
+                        sock = socket.create_connection((self.server_ip_add, self.port))
+                    file.seek(offset)
+                    self.fetch_range(sock, filename, offset, length, file)
+
+                except (OSError, ProtocolError) as e:
+                    if sock is not None:
+                        sock.close()
+                        sock = None
+
+                    if attempts + 1 >= CHUNK_RETRIES:
+                        failures.append(f"bytes {offset}-{offset + length}: {e}")
+                    else:
+                        chunks.put((offset, length, attempts + 1))
+
+        if sock is not None:
+            sock.close()
+
+    # Requests one byte range over a data connection and writes it to file at
+    # the file's current position.
+    #
+    # Returns:
+    #     dict: The FILE_META the server sent for the range.
+    def fetch_range(self, sock, filename, offset, length, file):
+        send_command(sock, f"/get {filename} {offset} {length}")
+
+        frame = recv_frame(sock)
+        if frame is None:
+            raise ConnectionResetError("Connection to the server lost.")
+
+        frame_type, payload = frame
+        if frame_type != FRAME_FILE_META:
+            message = payload.decode('utf-8', 'replace')
+            raise ProtocolError(message[len('Error: '):] if message.startswith('Error: ') else message)
+
+        meta = decode_file_meta(payload)
+        if meta['offset'] != offset or meta['length'] != length:
+            raise ProtocolError(f"Server returned bytes {meta['offset']}-{meta['offset'] + meta['length']}")
+
+        recv_file_data(sock, file)
+        return meta
 
     def send_broadcast(self, message):
-        self.client_socket.send(f'/broadcast {message}'.encode('utf-8'))
+        send_command(self.client_socket, f'/broadcast {message}')
 
     def send_unicast(self, recipient_handle, message):
-        self.client_socket.send(f'/unicast {recipient_handle} {message}'.encode('utf-8'))
+        send_command(self.client_socket, f'/message {recipient_handle} {message}')
+
+
+# One command the headless client sent and is waiting on a reply for.
+class PendingRequest:
+    def __init__(self, command):
+        self.command = command
+        self.name = command.split()[0]
+        self.lines_expected = None  # /dir: file lines still to come once the header arrives
+        self.failed = False  # /mget: a file of the batch was not received
+
+
+# FileExchangeClient without the GUI, for scripts and batch jobs.
+#
+# Commands are pipelined: up to `window` of them are sent before the first
+# reply comes back. The server answers every command in the order it was
+# received, so replies are matched to requests first-in first-out, using the
+# shape of each command's reply to tell where it ends (a FILE_META and its
+# data for /get, a header and the announced file lines for /dir, the final
+# FILE_STATUS for /store, /mstore and /mget, one message for everything else). Chat from other
+# clients comes in CHAT frames, which can arrive at any point and are printed
+# as they come.
+#
+# An upload still has to wait for the server's FILE_STATUS before its data can
+# follow the metadata, so /store pauses sending until that arrives.
+class HeadlessClient(FileExchangeClient):
+    def __init__(self, host, port, window=PIPELINE_WINDOW):
+        super().__init__(host, port)
+        self.window = threading.BoundedSemaphore(window)
+        self.pending = deque()
+        self.lock = threading.Condition()
+        self.sent = 0
+        self.failed = 0
+
+    # Output goes to stdout only; there is no GUI draining message_queue.
+    def notify(self, message):
+        print(message, flush=True)
+
+    # /pget runs in the background; one that fails counts as a failed command.
+    def parallel_download(self, *args):
+        received = super().parallel_download(*args)
+        if not received:
+            with self.lock:
+                self.failed += 1
+        return received
+
+    def connect(self):
+        self.client_socket.connect((self.server_ip_add, self.port))
+        self.is_connected = True
+        threading.Thread(target=self.receive_replies, name='replies', daemon=True).start()
+
+    # Sends commands in order without waiting for their replies, then waits
+    # for every reply.
+    #
+    # Args:
+    #     commands (iterable): Command lines; blank lines and lines starting
+    #         with # are skipped.
+    #
+    # Returns:
+    #     bool: True if every command succeeded.
+    def run(self, commands):
+        for command in commands:
+            command = command.strip()
+            if not command or command.startswith('#'):
+                continue
+
+            if not self.is_connected:
+                self.failed += 1
+                continue
+
+            if not self.is_command(command):
+                self.failed += 1
+                continue
+
+            if command.startswith(('/store', '/pget')):
+                # Nothing else can be sent until the upload's data has gone
+                # out, so let earlier replies drain first rather than have the
+                # wait for FILE_STATUS time out behind them. /pget runs on its
+                # own connections and has to see what earlier commands did,
+                # such as a /store of the same file.
+                with self.lock:
+                    while self.pending and self.is_connected:
+                        self.lock.wait()
+
+            if command.split()[0] in LOCAL_COMMANDS:
+                self.send_command(command)
+                continue
+
+            self.window.acquire()
+            request = PendingRequest(command)
+            with self.lock:
+                self.pending.append(request)
+
+            if self.send_command(command):
+                self.sent += 1
+            else:
+                with self.lock:
+                    self.pending.remove(request)
+                self.window.release()
+                self.failed += 1
+
+        with self.lock:
+            while self.pending and self.is_connected:
+                self.lock.wait()
+
+        for thread in self.background_threads:
+            thread.join()
+
+        self.client_socket.close()
+        return self.failed == 0
+
+    # Receives replies and hands each one to the oldest pending request.
+    def receive_replies(self):
+        try:
+            while True:
+                frame = recv_frame(self.client_socket)
+                if frame is None:
+                    break
+
+                frame_type, payload = frame
+                if frame_type == FRAME_CHAT:
+                    self.notify(payload.decode('utf-8'))
+                    continue
+
+                request = self.pending[0] if self.pending else None
+                text = payload.decode('utf-8') if frame_type == FRAME_MESSAGE else None
+
+                if request is None:
+                    if text is not None:
+                        self.notify(text)
+                    continue
+
+                done, failed = self.handle_reply(request, frame_type, payload, text)
+                if done:
+                    self.complete(request, failed)
+                    if request.name == '/leave':
+                        break
+
+        except (OSError, ProtocolError, UnicodeDecodeError) as e:
+            if self.pending:
+                self.notify(f"Error: {e}")
+
+        with self.lock:
+            if self.pending:
+                self.notify("Connection to the server lost.")
+            self.failed += len(self.pending)
+            self.pending.clear()
+            self.is_connected = False
+            self.lock.notify_all()
+
+    # Returns:
+    #     tuple: (done, failed) for the request the frame belongs to.
+    def handle_reply(self, request, frame_type, payload, text):
+        if frame_type == FRAME_FILE_STATUS and request.name == '/store':
+            status = decode_file_meta(payload)
+            if 'stored' not in status:
+                # The ranges to upload; send_file is waiting for them
+                self.file_status_queue.put(status)
+                return False, False
+            if not status['stored']:
+                self.notify(status['error'])
+            return True, not status['stored']
+
+        if frame_type == FRAME_FILE_STATUS and request.name in ['/mstore', '/mget']:
+            status = decode_file_meta(payload)
+            for line in summarize_batch(status):
+                self.notify(line)
+            return True, request.failed or bool(status.get('errors') or status.get('missing'))
+
+        if frame_type == FRAME_FILE_META and request.name == '/get':
+            return True, not self.receive_file(decode_file_meta(payload))
+
+        if frame_type == FRAME_FILE_META and request.name == '/mget':
+            if not self.receive_file(decode_file_meta(payload)):
+                request.failed = True
+            return False, False
+
+        if text is None:
+            raise ProtocolError(f"Unexpected frame type {frame_type} in reply to {request.command}.")
+
+        self.notify(text)
+
+        if request.name == '/dir' and request.lines_expected is None and text.startswith('Server Directory'):
+            # "Server Directory (page p of n, count files, lines on this page)"
+            request.lines_expected = int(re.findall(r'\d+', text)[3])
+            return request.lines_expected == 0, False
+
+        if request.lines_expected:
+            request.lines_expected -= len(text.split('\n'))
+            return request.lines_expected <= 0, False
+
+        if request.name == '/register' and text.startswith('Welcome'):
+            self.handle = text.split()[1][:-1]
+
+        return True, text.startswith('Error')
+
+    def complete(self, request, failed):
+        with self.lock:
+            self.pending.popleft()
+            if failed:
+                self.failed += 1
+            self.lock.notify_all()
+        self.window.release()
+
+
+# Runs the headless client for the command line.
+#
+# Returns:
+#     int: The exit status, 0 if every command succeeded.
+def run_headless(args):
+    if args.commands:
+        commands = args.commands
+    elif args.file and args.file != '-':
+        with open(args.file) as file:
+            commands = file.read().splitlines()
+    else:
+        commands = sys.stdin
+
+    if args.handle:
+        commands = [f"/register {args.handle}", *commands]
+
+    client = HeadlessClient(args.host, args.port, args.window)
+    try:
+        client.connect()
+    except OSError as e:
+        print(f"Error: Connection to the Server has failed: {e}", file=sys.stderr)
+        return 2
+
+    start = time.time()
+    ok = client.run(commands)
+    elapsed = max(time.time() - start, 1e-6)
+    print(f"{client.sent} commands in {elapsed:.2f}s ({client.sent / elapsed * 60:.0f}/min), {client.failed} failed",
+          file=sys.stderr)
+    return 0 if ok else 1
 
 
 class FileExchangeGUI:
     def __init__(self):
+        global tk, tkst
+        import tkinter as tk
+        import tkinter.scrolledtext as tkst
+
         self.file_exchange_client = None
         self.root = tk.Tk()
         self.root.title("File Exchange Client")
@@ -208,10 +866,25 @@ class FileExchangeGUI:
         self.send_button = tk.Button(self.root, text="Send Command", command=self.send_command)
         self.send_button.pack(pady=10)
 
+        # Tk may only be used from the thread running its main loop, so the
+        # client's threads never call into the GUI; it looks for their
+        # messages itself
+        self.root.after(MESSAGE_POLL_INTERVAL, self.poll_messages)
+
+    # Adds text to the end of the text area, trimming the oldest lines past
+    # MAX_SCROLLBACK_LINES.
+    def append_text(self, text):
+        self.text_area.insert(tk.END, text)
+
+        lines = int(self.text_area.index('end-1c').split('.')[0])
+        if lines > MAX_SCROLLBACK_LINES:
+            self.text_area.delete('1.0', f"{lines - MAX_SCROLLBACK_LINES + 1}.0")
+
+        self.text_area.yview(tk.END)
+
     def send_command(self):
         command = self.entry_command.get()
-        self.text_area.insert(tk.END, f"\n{command}\n")
-        self.text_area.yview(tk.END)
+        self.append_text(f"\n{command}\n")
         self.entry_command.delete(0, tk.END)
 
         if self.file_exchange_client is None:
@@ -226,97 +899,120 @@ class FileExchangeGUI:
                     receive_thread = threading.Thread(target=self.file_exchange_client.receive_data)
                     receive_thread.start()
 
-                    self.text_area.insert(tk.END, f"Connected to server {server_ip_add} on port {port}\n")
-                    self.text_area.yview(tk.END)
+                    self.append_text(f"Connected to server {server_ip_add} on port {port}\n")
 
                 except ConnectionRefusedError:
                     print("Error: Connection to the Server has failed! Please check IP Address and Port Number")
-                    self.text_area.insert(tk.END, "Error: Connection to the Server has failed! Please check IP Address and Port Number\n")
-                    self.text_area.yview(tk.END)
+                    self.append_text("Error: Connection to the Server has failed! Please check IP Address and Port Number\n")
                     self.file_exchange_client = None
 
                 except socket.timeout:
                     print("Error: Connection to the Server has failed! Please check IP Address and Port Number")
-                    self.text_area.insert(tk.END, "Error: Connection to the Server has failed! Please check IP Address and Port Number\n")
-                    self.text_area.yview(tk.END)
+                    self.append_text("Error: Connection to the Server has failed! Please check IP Address and Port Number\n")
                     self.file_exchange_client = None
 
                 except Exception:
                     print("Error: Connection to the Server has failed! Please check IP Address and Port Number")
-                    self.text_area.insert(tk.END, "Error: Connection to the Server has failed! Please check IP Address and Port Number\n")
-                    self.text_area.yview(tk.END)
+                    self.append_text("Error: Connection to the Server has failed! Please check IP Address and Port Number\n")
                     self.file_exchange_client = None
 
             elif command.startswith('/join') and len(command.split()) != 3:
                 print("Error: Command parameters do not match or is not allowed.")
-                self.text_area.insert(tk.END, "Error: Command parameters do not match or is not allowed.\n")
-                self.text_area.yview(tk.END)
+                self.append_text("Error: Command parameters do not match or is not allowed.\n")
 
             elif command == "/?":
                 help_info = "Connect to the server application: /join <server_ip> <port>\n"
                 print(help_info)
-                self.text_area.insert(tk.END, help_info)
-                self.text_area.yview(tk.END)
+                self.append_text(help_info)
 
-            elif command.split()[0] in ['/leave', '/dir', '/register', '/store', '/get']:
+            elif command.split()[0] in ['/leave', '/dir', '/register', '/store', '/get', '/pget', '/mstore', '/mget', '/compress', '/stats']:
                 print("Error: Please connect to the server before entering a command. Enter /? for help.")
-                self.text_area.insert(tk.END, "Error: Please connect to the server before entering a command. Enter /? for help.\n")
-                self.text_area.yview(tk.END)
+                self.append_text("Error: Please connect to the server before entering a command. Enter /? for help.\n")
 
             else:
                 print("Error: Invalid Input. Enter /? for help.")
-                self.text_area.insert(tk.END, "Error: Invalid Input. Enter /? for help.\n")
-                self.text_area.yview(tk.END)
+                self.append_text("Error: Invalid Input. Enter /? for help.\n")
 
         elif not self.file_exchange_client.is_connected:
-            self.text_area.insert(tk.END, "Error: Connection to the server lost.\n")
-            self.text_area.yview(tk.END)
+            self.append_text("Error: Connection to the server lost.\n")
 
         else:
             if self.file_exchange_client.handle and command.startswith('/register') and len(command.split()) == 2:
                 print("Error: You are already registered with the server.")
-                self.text_area.insert(tk.END, "Error: You are already registered with the server.\n")
-                self.text_area.yview(tk.END)
+                self.append_text("Error: You are already registered with the server.\n")
 
-            elif not self.file_exchange_client.handle and command.startswith(('/dir', '/store', '/get', '/broadcast', '/message')):
+            elif not self.file_exchange_client.handle and command.startswith(('/dir', '/store', '/get', '/pget', '/mstore', '/mget', '/broadcast', '/message')):
                 print("Error: You are not registered with the server. Please register first. Type /? for help.")
-                self.text_area.insert(tk.END, "Error: You are not registered with the server. Please register first. Type /? for help.\n")
-                self.text_area.yview(tk.END)
+                self.append_text("Error: You are not registered with the server. Please register first. Type /? for help.\n")
 
             elif command == "/?":
-                help_info = "Register with the server: /register <handle>\n"
+                help_info = "Register with the server: /register <handle>\nSet compression for /store and /get: /compress <codec>[,<codec>...] | none\n"
                 print(help_info)
-                self.text_area.insert(tk.END, help_info)
-                self.text_area.yview(tk.END)
+                self.append_text(help_info)
 
             elif command.startswith('/join'):
                 print("Error: You are already connected to the server.")
-                self.text_area.insert(tk.END, "Error: You are already connected to the server.\n")
-                self.text_area.yview(tk.END)
+                self.append_text("Error: You are already connected to the server.\n")
 
             else:
                 print(command)
                 self.file_exchange_client.send_command(command)
                 self.text_area.yview(tk.END)
 
-            self.root.after(100, self.update_text_area)
+    # Checks for new messages every MESSAGE_POLL_INTERVAL ms. If more are
+    # waiting after a batch, the next one follows as soon as Tk has handled
+    # pending input and redrawn.
+    def poll_messages(self):
+        client = self.file_exchange_client
+        if client is not None and client.update_event.is_set():
+            self.update_text_area()
+
+        client = self.file_exchange_client
+        waiting = client is not None and client.update_event.is_set()
+        self.root.after(1 if waiting else MESSAGE_POLL_INTERVAL, self.poll_messages)
 
+    # Moves waiting messages to the text area, MESSAGE_BATCH at a time with a
+    # single insert each.
     def update_text_area(self):
-        if self.file_exchange_client.is_connected:
-            while not self.file_exchange_client.message_queue.empty():
-                message = self.file_exchange_client.message_queue.get()
-                self.text_area.insert(tk.END, f"{message}\n")
-                self.text_area.yview(tk.END)
-                if message.startswith('Connection closed.'):
-                    self.file_exchange_client = None
-                    break
-                
-        self.root.after(100, self.update_text_area)
+        client = self.file_exchange_client
+        if client is None:
+            return
+
+        # Cleared first, so a message queued while draining sets it again
+        client.update_event.clear()
+
+        messages = []
+        while len(messages) < MESSAGE_BATCH:
+            try:
+                messages.append(client.message_queue.get_nowait())
+            except Empty:
+                break
+
+        if messages:
+            self.append_text(''.join(f"{message}\n" for message in messages))
+
+        if any(message.startswith('Connection closed.') for message in messages):
+            self.file_exchange_client = None
+        elif not client.message_queue.empty():
+            client.update_event.set()
 
     def run(self):
         self.root.mainloop()
 
 
 if __name__ == "__main__":
-    gui = FileExchangeGUI()
-    gui.run()
+    parser = argparse.ArgumentParser(description="File Exchange Client. Opens the GUI unless --host is given.")
+    parser.add_argument('--host', help="Connect to this server and run commands without the GUI")
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--handle', help="Register with this handle before running the commands")
+    parser.add_argument('-f', '--file', help="Read commands from this file, one per line ('-' for stdin)")
+    parser.add_argument('--window', type=int, default=PIPELINE_WINDOW,
+                        help="Commands to send ahead of their replies")
+    parser.add_argument('commands', nargs='*', help="Commands to run, e.g. '/get notes.txt'; default: read stdin")
+    args = parser.parse_args()
+
+    if args.host is None:
+        gui = FileExchangeGUI()
+        gui.run()
+    else:
+        sys.exit(run_headless(args))
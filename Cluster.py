@@ -0,0 +1,275 @@
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+from Protocol import FRAME_COMMAND, ProtocolError, encode_frame, recv_frame
+from Registry import ClientRegistry
+
+# Seconds a worker waits for the coordinator to answer before giving up.
+COORDINATOR_TIMEOUT = 5
+
+
+# Multi-process mode.
+#
+# With --workers N the server runs N worker processes, each a complete
+# FileExchangeServer with its own engine, index and cache, all accepting
+# connections on the same port through SO_REUSEPORT so the kernel spreads
+# clients across them. The parent process only runs a Coordinator, which the
+# workers reach over a Unix socket. It is the one place that knows which worker
+# holds which handle, so a handle is claimed there before a worker registers
+# it, and /message and /broadcast for clients on other workers are relayed
+# through it. Workers also announce the files they store so the others can
+# update their indexes without waiting for a rescan.
+#
+# Messages on the Unix socket are COMMAND frames carrying a JSON object with an
+# 'op' field. A worker's requests that need an answer carry an 'id', which the
+# coordinator copies into its reply.
+
+
+def encode_op(op, **fields):
+    return encode_frame(FRAME_COMMAND, json.dumps(dict(fields, op=op)).encode('utf-8'))
+
+
+# Reads the next message from a coordinator or worker socket.
+#
+# Returns:
+#     dict: The message, or None once the other side has gone away.
+def recv_op(sock):
+    try:
+        frame = recv_frame(sock)
+        return json.loads(frame[1].decode('utf-8')) if frame is not None else None
+    except (OSError, ValueError, ProtocolError):
+        return None
+
+
+# One worker as seen by the coordinator.
+class WorkerPeer:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()  # coordinator threads of other workers also send here
+
+    def send(self, op, **fields):
+        try:
+            with self.lock:
+                self.sock.sendall(encode_op(op, **fields))
+        except OSError:
+            pass  # its own thread notices the worker is gone
+
+
+# Runs in the parent process. Every worker connection gets a thread.
+#
+# Attributes:
+#     path (str): The Unix socket workers connect to.
+#     handles (dict): handle -> WorkerPeer holding it.
+class Coordinator:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.handles = {}
+        self.peers = []
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        threading.Thread(target=self.serve, name='coordinator', daemon=True).start()
+
+    def serve(self):
+        while True:
+            sock, _ = self.sock.accept()
+            threading.Thread(target=self.handle_worker, args=(WorkerPeer(sock),), daemon=True).start()
+
+    def handle_worker(self, peer):
+        with self.lock:
+            self.peers.append(peer)
+
+        while True:
+            message = recv_op(peer.sock)
+            if message is None:
+                break
+            self.handle_op(peer, message)
+
+        # A worker that exits takes its clients with it
+        with self.lock:
+            self.peers.remove(peer)
+            for handle in [handle for handle, owner in self.handles.items() if owner is peer]:
+                del self.handles[handle]
+        peer.sock.close()
+
+    def handle_op(self, peer, message):
+        op = message['op']
+
+        if op == 'register':
+            with self.lock:
+                claimed = message['handle'] not in self.handles
+                if claimed:
+                    self.handles[message['handle']] = peer
+            peer.send('reply', id=message['id'], result=claimed)
+
+        elif op == 'unregister':
+            with self.lock:
+                if self.handles.get(message['handle']) is peer:
+                    del self.handles[message['handle']]
+
+        elif op == 'message':
+            with self.lock:
+                owner = self.handles.get(message['handle'])
+            if owner is not None:
+                owner.send('deliver', handle=message['handle'], message=message['message'])
+            peer.send('reply', id=message['id'], result=owner is not None)
+
+        elif op in ['broadcast', 'file']:
+            with self.lock:
+                others = [other for other in self.peers if other is not peer]
+            for other in others:
+                other.send(**message)
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+# A worker's connection to the coordinator.
+#
+# Requests block the calling thread until the coordinator answers, which is one
+# round trip over the Unix socket. Messages the coordinator relays from other
+# workers are handed to the callbacks on the link's own thread.
+#
+# Attributes:
+#     on_deliver (callable): Called with (handle, message) for chat to a local
+#         client, with handle None for a broadcast.
+#     on_file (callable): Called with (filename, size, mtime, sha256) when
+#         another worker has stored a file.
+class ClusterLink:
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.waiting = {}  # request id -> [threading.Event, result]
+        self.on_deliver = None
+        self.on_file = None
+        threading.Thread(target=self.run, name='cluster-link', daemon=True).start()
+
+    def send(self, op, **fields):
+        with self.lock:
+            self.sock.sendall(encode_op(op, **fields))
+
+    # Sends a request and waits for the coordinator's answer.
+    #
+    # Raises:
+    #     ConnectionError: If the coordinator does not answer in time.
+    def request(self, op, **fields):
+        with self.lock:
+            self.next_id += 1
+            request_id = self.next_id
+            waiter = self.waiting[request_id] = [threading.Event(), None]
+            self.sock.sendall(encode_op(op, id=request_id, **fields))
+
+        try:
+            if not waiter[0].wait(COORDINATOR_TIMEOUT):
+                raise ConnectionError("The coordinator did not answer.")
+            return waiter[1]
+        finally:
+            with self.lock:
+                self.waiting.pop(request_id, None)
+
+    def run(self):
+        while True:
+            message = recv_op(self.sock)
+            if message is None:
+                break
+
+            if message['op'] == 'reply':
+                with self.lock:
+                    waiter = self.waiting.get(message['id'])
+                if waiter is not None:
+                    waiter[1] = message['result']
+                    waiter[0].set()
+
+            elif message['op'] == 'deliver':
+                self.on_deliver(message['handle'], message['message'])
+
+            elif message['op'] == 'broadcast':
+                self.on_deliver(None, message['message'])
+
+            elif message['op'] == 'file':
+                self.on_file(message['filename'], message['size'], message['mtime'], message['sha256'])
+
+        # Without the coordinator handles could no longer be kept unique, so
+        # the worker stops along with it.
+        print(f"Worker {os.getpid()} lost the coordinator; exiting.", flush=True)
+        os._exit(1)
+
+
+# ClientRegistry for a worker: a handle is claimed with the coordinator before
+# it is registered locally, and chat for handles on other workers is relayed.
+class ClusterRegistry(ClientRegistry):
+    def __init__(self, link):
+        super().__init__()
+        self.link = link
+
+    def register(self, handle, connection):
+        if handle in self.by_handle or not self.link.request('register', handle=handle):
+            return False
+
+        if not super().register(handle, connection):
+            self.link.send('unregister', handle=handle)
+            return False
+        return True
+
+    def unregister(self, connection):
+        handle = super().unregister(connection)
+        if handle is not None:
+            self.link.send('unregister', handle=handle)
+        return handle
+
+    def forward_message(self, handle, message):
+        return self.link.request('message', handle=handle, message=message)
+
+    def forward_broadcast(self, message):
+        self.link.send('broadcast', message=message)
+
+
+# Runs the server as worker processes, with the coordinator in this process.
+# Returns once every worker has exited, or on SIGTERM or Ctrl+C after stopping
+# them.
+#
+# Args:
+#     count (int): Number of worker processes.
+#     target (callable): Starts a worker. Called in the new process with the
+#         options plus cluster_path and worker_id.
+#     options: Keyword arguments for target.
+def run_workers(count, target, **options):
+    directory = tempfile.mkdtemp(prefix='fileexchange-')
+    coordinator = Coordinator(os.path.join(directory, 'coordinator.sock'))
+
+    # Spawned rather than forked, since the coordinator's threads are running
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=target, kwargs=dict(options, cluster_path=coordinator.path, worker_id=index),
+                               name=f"worker-{index}")
+               for index in range(count)]
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            if worker.pid is not None:
+                worker.join()
+        coordinator.close()
+        os.rmdir(directory)
@@ -0,0 +1,217 @@
+import lzma
+import os
+import zlib
+from Protocol import BUFFER_SIZE, FRAME_FILE_DATA, HEADER, ProtocolError, encode_frame, recv_exact, recv_header
+
+# Per-transfer stream compression.
+#
+# The codec is negotiated for every transfer: a client lists the codecs it
+# accepts (codecs=zlib,lzma after /get, or a codecs list in an upload's
+# FILE_META) and the sender picks one, reporting it back in FILE_META or
+# FILE_STATUS. With a codec other than 'none' a byte range no longer travels as
+# one FILE_DATA frame of known length; instead its compressed stream is cut
+# into FILE_DATA frames of whatever the compressor produces, and an empty
+# FILE_DATA frame marks the end.
+CODECS = ['zlib', 'lzma', 'none']
+
+# Formats that are already compressed and would only cost CPU to compress again.
+COMPRESSED_EXTENSIONS = {
+    '.7z', '.aac', '.avi', '.br', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jpeg', '.jpg', '.lz4',
+    '.lzma', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.odt', '.ogg', '.png', '.pptx', '.rar', '.tgz', '.webm',
+    '.webp', '.xlsx', '.xz', '.zip', '.zst',
+}
+
+# How much of a file the heuristic test-compresses, and the ratio a sample
+# must beat for compression to be worth it.
+SAMPLE_SIZE = 64 * 1024
+MIN_SAVING_RATIO = 0.9
+
+
+def get_compressor(codec):
+    if codec == 'zlib':
+        return zlib.compressobj(6)
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=1)
+    raise ValueError(f"Unknown codec {codec!r}")
+
+
+# Decompresses one stream in bounded pieces, so a small frame that expands to
+# gigabytes never has to fit in memory at once.
+class Decompressor:
+    def __init__(self, codec):
+        if codec == 'zlib':
+            self.decompressor = zlib.decompressobj()
+        elif codec == 'lzma':
+            self.decompressor = lzma.LZMADecompressor()
+        else:
+            raise ValueError(f"Unknown codec {codec!r}")
+        self.codec = codec
+
+    # Yields the decompressed output of one compressed block.
+    def feed(self, data):
+        if self.codec == 'zlib':
+            output = self.decompressor.decompress(data, BUFFER_SIZE)
+            while output:
+                yield output
+                output = self.decompressor.decompress(self.decompressor.unconsumed_tail, BUFFER_SIZE)
+        else:
+            output = self.decompressor.decompress(data, BUFFER_SIZE)
+            while output:
+                yield output
+                if self.decompressor.needs_input or self.decompressor.eof:
+                    break
+                output = self.decompressor.decompress(b'', BUFFER_SIZE)
+
+    def flush(self):
+        if self.codec == 'zlib':
+            output = self.decompressor.flush()
+            if output:
+                yield output
+
+
+# Picks a codec for a file.
+#
+# Args:
+#     filename (str): Used to skip formats that are already compressed.
+#     offered (list): Codecs the receiver accepts, in order of preference.
+#
+# Returns:
+#     str: A codec from CODECS.
+def choose_codec(filename, offered):
+    codecs = [codec for codec in offered if codec in CODECS and codec != 'none']
+    if not codecs or os.path.splitext(filename)[1].lower() in COMPRESSED_EXTENSIONS:
+        return 'none'
+    return codecs[0]
+
+
+# Returns the codecs offered in an upload's FILE_META.
+def offered_codecs(meta):
+    codecs = meta.get('codecs', [])
+    if not isinstance(codecs, list) or not all(isinstance(codec, str) for codec in codecs):
+        raise ProtocolError("Invalid codecs in file metadata.")
+    return codecs
+
+
+# Test-compresses the start of a file to see whether compression pays off.
+def is_compressible(sample):
+    return len(zlib.compress(sample, 1)) <= len(sample) * MIN_SAVING_RATIO
+
+
+def parse_codecs(value):
+    return [codec for codec in value.split(',') if codec]
+
+
+# Reads SAMPLE_SIZE bytes from a list of (file, offset, length) segments.
+def read_sample(segments):
+    sample = b''
+    for file, offset, length in segments:
+        file.seek(offset)
+        sample += file.read(min(length, SAMPLE_SIZE - len(sample)))
+        if len(sample) >= SAMPLE_SIZE:
+            break
+    return sample
+
+
+# Yields the compressed frames for a byte range: one FILE_DATA frame per
+# compressor output block and an empty one at the end.
+#
+# Args:
+#     segments: Iterable of (file, offset, length).
+#     codec (str): The codec to use.
+def compress_frames(segments, codec):
+    compressor = get_compressor(codec)
+
+    for file, offset, length in segments:
+        file.seek(offset)
+        remaining = length
+        while remaining > 0:
+            chunk = file.read(min(BUFFER_SIZE, remaining))
+            if not chunk:
+                raise ProtocolError("File shrank while it was being sent.")
+            remaining -= len(chunk)
+
+            yield from encode_blocks(compressor.compress(chunk))
+
+    yield from encode_blocks(compressor.flush())
+    yield encode_frame(FRAME_FILE_DATA)
+
+
+# Frames compressor output, at most BUFFER_SIZE bytes per frame so the receiver
+# can refuse anything larger.
+def encode_blocks(output):
+    for start in range(0, len(output), BUFFER_SIZE):
+        yield encode_frame(FRAME_FILE_DATA, output[start:start + BUFFER_SIZE])
+
+
+# Sends a byte range of a file compressed with codec.
+#
+# Returns:
+#     int: Bytes put on the wire, including frame headers.
+def send_compressed_data(sock, segments, codec):
+    sent = 0
+    for frame in compress_frames(segments, codec):
+        sock.sendall(frame)
+        sent += len(frame)
+    return sent
+
+
+# Decompresses a byte range into a file as its compressed blocks arrive, and
+# checks that it comes out at exactly the announced length.
+#
+# Args:
+#     file (file object): Where the decompressed bytes go; anything with a
+#         write method, such as a storage backend's upload.
+#     codec (str): The negotiated codec.
+#     length (int): The exact number of decompressed bytes expected.
+#     digest (hashlib hash): Optional hash updated with the decompressed bytes.
+class DecompressingWriter:
+    def __init__(self, file, codec, length, digest=None):
+        self.file = file
+        self.decompressor = Decompressor(codec)
+        self.length = length
+        self.digest = digest
+        self.written = 0
+
+    def write(self, data):
+        self.write_output(self.decompressor.feed(data))
+
+    def finish(self):
+        self.write_output(self.decompressor.flush())
+        if self.written != self.length:
+            raise ProtocolError("Compressed data is shorter than the announced length.")
+
+    def write_output(self, outputs):
+        for output in outputs:
+            self.written += len(output)
+            if self.written > self.length:
+                raise ProtocolError("Compressed data expands past the announced length.")
+            self.file.write(output)
+            if self.digest is not None:
+                self.digest.update(output)
+
+
+# Receives a compressed byte range and writes it, decompressed, to file.
+#
+# Returns:
+#     int: Bytes received on the wire, including frame headers.
+def recv_compressed_data(sock, file, codec, length, digest=None):
+    writer = DecompressingWriter(file, codec, length, digest)
+    received = 0
+
+    while True:
+        header = recv_header(sock)
+        if header is None:
+            raise ConnectionResetError("Connection closed in the middle of a file transfer.")
+
+        frame_type, size = header
+        if frame_type != FRAME_FILE_DATA:
+            raise ProtocolError(f"Expected file data, got frame type {frame_type}.")
+        if size > BUFFER_SIZE:
+            raise ProtocolError(f"Compressed block of {size} bytes is too large.")
+        received += HEADER.size + size
+
+        if size == 0:
+            writer.finish()
+            return received
+
+        writer.write(recv_exact(sock, size))
@@ -0,0 +1,316 @@
+import asyncio
+import socket
+import threading
+import time
+from collections import deque
+from Protocol import FRAME_CHAT, ProtocolError, encode_frame
+from Shaping import ShapedSocket, ShapedWriter
+
+SLOW_CLIENT_POLICIES = ['drop', 'coalesce', 'disconnect']
+
+# Chat messages a client may have waiting before the slow-client policy kicks in.
+MAX_PENDING_MESSAGES = 256
+
+# Responses and transfers a handler may queue before it stops reading the
+# client's next command until the writer catches up.
+MAX_PENDING_REPLIES = 64
+
+# Seconds a closing connection may go without sending anything before it is
+# cut off. It gets as long as it needs to flush its queue while it keeps
+# sending.
+FLUSH_TIMEOUT = 10
+
+
+# Outbound side of a client connection.
+#
+# Everything the server writes to a client goes through its Outbox: replies,
+# chat messages from other clients and whole file transfers, in the order they
+# were queued. A single writer per connection drains the queue, so a sender
+# never blocks on someone else's socket and a broadcast can never land in the
+# middle of a FILE_DATA frame.
+#
+# An item is either encoded frame bytes or a transfer job, a callable the
+# writer runs with exclusive use of the socket (or StreamWriter). Transfer jobs
+# are paced by the connection's token buckets, if any; see Shaping.py.
+#
+# Chat messages are queued as droppable. Once MAX_PENDING_MESSAGES of them are
+# waiting the policy decides what happens to the next one:
+#     drop: discard the new message.
+#     coalesce: discard the oldest waiting message, keeping the newest ones.
+#     disconnect: close the connection.
+# With drop and coalesce the client is told how many messages it missed.
+#
+# Attributes:
+#     address (tuple): The client's (ip, port).
+#     buckets (list): TokenBuckets that transfer jobs draw from.
+#     dropped (int): Chat messages discarded so far.
+#     last_sent (float): time.monotonic() when the writer last got data out.
+class Outbox:
+    def __init__(self, address, policy='drop', max_pending=MAX_PENDING_MESSAGES, buckets=()):
+        if policy not in SLOW_CLIENT_POLICIES:
+            raise ValueError(f"Unknown slow client policy {policy!r}, expected one of {SLOW_CLIENT_POLICIES}")
+
+        self.address = address
+        self.buckets = list(buckets)
+        self.policy = policy
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.items = deque()  # (item, droppable)
+        self.pending_messages = 0
+        self.dropped = 0
+        self.unreported_drops = 0
+        self.sending = False  # the writer is busy with an item
+        self.closed = False
+        self.last_sent = time.monotonic()
+
+    # Queues a frame or transfer job.
+    #
+    # Args:
+    #     item (bytes or callable): An encoded frame or a transfer job.
+    #     droppable (bool): True for chat that may be discarded if the client
+    #         falls behind.
+    #
+    # Returns:
+    #     bool: False if the item was discarded.
+    def put(self, item, droppable=False):
+        disconnect = False
+
+        with self.lock:
+            if self.closed:
+                return False
+
+            if droppable and self.pending_messages >= self.max_pending:
+                if self.policy == 'disconnect':
+                    self.closed = disconnect = True
+                    self.items.clear()
+
+                elif self.policy == 'coalesce':
+                    for index, (_, is_droppable) in enumerate(self.items):
+                        if is_droppable:
+                            del self.items[index]
+                            self.pending_messages -= 1
+                            break
+                    self.count_drop()
+
+                else:
+                    self.count_drop()
+                    return False
+
+            if not disconnect:
+                self.items.append((item, droppable))
+                if droppable:
+                    self.pending_messages += 1
+
+        if disconnect:
+            self.abort()
+            return False
+
+        self.wake()
+        return True
+
+    def count_drop(self):
+        self.dropped += 1
+        self.unreported_drops += 1
+
+    # Called by the writer whenever data got out, count bytes of it.
+    def made_progress(self, count):
+        self.last_sent = time.monotonic()
+
+    # Seconds a closing connection that began to flush at started has left,
+    # which run out only if the writer stops getting data out.
+    def flush_time_left(self, started, timeout):
+        return max(started, self.last_sent) + timeout - time.monotonic()
+
+    # Takes everything the writer can send in one go: a run of consecutive
+    # frames joined into one buffer, or a single transfer job. Must be called
+    # with the lock held.
+    #
+    # Returns:
+    #     bytes, callable or None if the queue is empty.
+    def take(self):
+        frames = []
+
+        if self.unreported_drops:
+            notice = f"Notice: {self.unreported_drops} messages were dropped because your connection fell behind."
+            frames.append(encode_frame(FRAME_CHAT, notice.encode('utf-8')))
+            self.unreported_drops = 0
+
+        while self.items:
+            item, droppable = self.items[0]
+            if callable(item):
+                if frames:
+                    break
+                self.items.popleft()
+                return item
+
+            self.items.popleft()
+            if droppable:
+                self.pending_messages -= 1
+            frames.append(item)
+
+        return b''.join(frames) if frames else None
+
+    def has_room(self):
+        return len(self.items) - self.pending_messages < MAX_PENDING_REPLIES
+
+    # True when nothing is being sent to the client or waiting to be, so a
+    # client that is not sending either is idle.
+    def is_idle(self):
+        return self.closed or (not self.items and not self.sending)
+
+    # Stops accepting items. The writer sends what is already queued and then
+    # closes the connection.
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.wake()
+
+    def wake(self):
+        raise NotImplementedError
+
+    def abort(self):
+        raise NotImplementedError
+
+
+# Outbox for the threaded engine, drained by its own writer thread.
+class ClientConnection(Outbox):
+    def __init__(self, sock, policy='drop', max_pending=MAX_PENDING_MESSAGES, buckets=()):
+        super().__init__(sock.getpeername(), policy, max_pending, buckets)
+        self.sock = sock
+        self.condition = threading.Condition(self.lock)
+        self.writer_thread = threading.Thread(target=self.run, name=f"writer-{self.address}", daemon=True)
+        self.writer_thread.start()
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    item = self.take()
+                    while item is None and not self.closed:
+                        self.condition.wait()
+                        item = self.take()
+                    self.sending = item is not None
+                    self.condition.notify_all()
+
+                if item is None:
+                    break
+
+                if callable(item):
+                    item(ShapedSocket(self.sock, self.buckets, self.made_progress))
+                else:
+                    self.sock.sendall(item)
+                    self.made_progress(len(item))
+
+        except (OSError, ProtocolError):
+            with self.lock:
+                self.closed = True
+                self.items.clear()
+
+            # The stream may have stopped halfway through a frame, so the
+            # connection is unusable; this also ends the handler's recv
+            self.abort()
+
+        finally:
+            with self.condition:
+                self.condition.notify_all()
+
+    # Blocks the handler while too many replies are waiting, so a client
+    # pipelining requests cannot grow the queue without limit.
+    def wait_for_room(self):
+        with self.condition:
+            while not self.has_room() and not self.closed:
+                self.condition.wait()
+
+    # Sends what is queued and closes the socket. Called by the handler thread
+    # once it is done reading from the client. The writer is aborted only once
+    # it has sent nothing for timeout seconds.
+    def flush_and_close(self, timeout=FLUSH_TIMEOUT):
+        self.close()
+
+        started = time.monotonic()
+        while self.writer_thread.is_alive() and self.flush_time_left(started, timeout) > 0:
+            self.writer_thread.join(self.flush_time_left(started, timeout))
+
+        if self.writer_thread.is_alive():
+            self.abort()
+            self.writer_thread.join()
+
+        self.sock.close()
+
+    def abort(self):
+        # Unblocks both the handler's recv and the writer's send
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.wake()
+
+
+# Outbox for the asyncio engine, drained by a writer task. All of its methods
+# must be called from the event loop thread.
+class AsyncClientConnection(Outbox):
+    def __init__(self, writer, policy='drop', max_pending=MAX_PENDING_MESSAGES, buckets=()):
+        super().__init__(writer.get_extra_info('peername'), policy, max_pending, buckets)
+        self.writer = writer
+        self.wakeup = asyncio.Event()
+        self.room = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def wake(self):
+        self.wakeup.set()
+
+    async def run(self):
+        try:
+            while True:
+                with self.lock:
+                    item = self.take()
+                    self.sending = item is not None
+                    if item is None and not self.closed:
+                        self.wakeup.clear()
+                self.room.set()
+
+                if item is None:
+                    if self.closed:
+                        break
+                    await self.wakeup.wait()
+                    continue
+
+                if callable(item):
+                    await item(ShapedWriter(self.writer, self.buckets, self.made_progress))
+                else:
+                    self.writer.write(item)
+                    await self.writer.drain()
+                    self.made_progress(len(item))
+
+        except (OSError, ProtocolError):
+            with self.lock:
+                self.closed = True
+                self.items.clear()
+
+        finally:
+            self.room.set()
+            self.writer.close()
+
+    async def wait_for_room(self):
+        while not self.has_room() and not self.closed:
+            self.room.clear()
+            await self.room.wait()
+
+    async def flush_and_close(self, timeout=FLUSH_TIMEOUT):
+        self.close()
+
+        started = time.monotonic()
+        while not self.task.done() and self.flush_time_left(started, timeout) > 0:
+            await asyncio.wait({self.task}, timeout=self.flush_time_left(started, timeout))
+
+        if not self.task.done():
+            self.abort()
+        await self.task
+
+    def abort(self):
+        self.writer.transport.abort()
+        self.wake()
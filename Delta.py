@@ -0,0 +1,267 @@
+import hashlib
+import math
+import zlib
+from Protocol import (BUFFER_SIZE, FRAME_FILE_DATA, FRAME_FILE_META, HEADER, ProtocolError, decode_file_meta,
+                      encode_file_data_header, encode_file_meta, recv_exact, recv_header)
+
+# Delta uploads, in the manner of rsync.
+#
+# A client re-uploading a file offers a delta with delta: true in its
+# FILE_META. If the server holds a copy of the file worth diffing against, its
+# FILE_STATUS carries a signature of that copy next to the ranges:
+#
+#     delta: {block_size, size, blocks: [[weak, strong], ...]}
+#
+# with one pair per block_size block, the weak checksum being Adler-32, which
+# can be rolled along the data a byte at a time, and the strong one a 128-bit
+# BLAKE2b. The client slides a window over its file looking for blocks the
+# server already has and sends the new contents as a sequence of
+#
+#     FILE_META {copy: [index, count]}  count blocks of the server's copy
+#     FILE_DATA                         literal bytes
+#
+# ended by an empty FILE_META. The server rebuilds the file into an ordinary
+# upload, so it is checked against the announced sha256 and moved into place
+# atomically like any other.
+
+# Files smaller than this are cheaper to send whole.
+DELTA_MIN_SIZE = 256 * 1024
+
+# Blocks are about sqrt(size) bytes, within these bounds. MAX_BLOCKS keeps the
+# signature of a huge file well under MAX_CONTROL_LENGTH.
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCKS = 100_000
+
+# Searching for matches costs a Python-level step per byte that did not match.
+# Once more than half of what was scanned, past the first SEARCH_BLOCKS blocks,
+# turned out to be literal, the file is taken to have been rewritten and the
+# rest is sent as-is.
+SEARCH_BLOCKS = 16
+
+ADLER_MOD = 65521
+
+
+def choose_block_size(size):
+    return max(MIN_BLOCK_SIZE, math.isqrt(size), -(-size // MAX_BLOCKS))
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+# Yields the bytes of a Download's byte range in pieces of at most BUFFER_SIZE.
+def read_range(download, offset, length):
+    for file, start, count in download.segments(offset, length):
+        file.seek(start)
+        while count > 0:
+            chunk = file.read(min(BUFFER_SIZE, count))
+            if not chunk:
+                raise ProtocolError("File shrank while it was being read.")
+            count -= len(chunk)
+            yield chunk
+
+
+# Computes the signature of a stored file for the client to diff against.
+#
+# Args:
+#     download: The file's Download from the storage backend.
+#
+# Returns:
+#     dict: {block_size, size, blocks} as sent in FILE_STATUS.
+def compute_signature(download):
+    block_size = choose_block_size(download.size)
+    blocks = []
+    pending = bytearray()
+
+    for chunk in read_range(download, 0, download.size):
+        pending += chunk
+        full = len(pending) - len(pending) % block_size
+        for start in range(0, full, block_size):
+            block = pending[start:start + block_size]
+            blocks.append([zlib.adler32(block), strong_hash(block)])
+        del pending[:full]
+
+    if pending:
+        blocks.append([zlib.adler32(pending), strong_hash(pending)])
+
+    return {'block_size': block_size, 'size': download.size, 'blocks': blocks}
+
+
+# Works out how to rebuild data from the server's copy.
+#
+# Args:
+#     data (bytes-like): The new contents, e.g. an mmap of the file.
+#     signature (dict): The server's signature of its copy.
+#
+# Yields:
+#     tuple: ('copy', index, count) for a run of the server's blocks or
+#     ('data', start, end) for a literal slice of data, in order.
+def compute_delta(data, signature):
+    block_size, blocks = signature['block_size'], signature['blocks']
+    table = {}  # weak -> {strong: block index}
+    for index, (weak, strong) in enumerate(blocks):
+        table.setdefault(weak, {}).setdefault(strong, index)
+
+    size = len(data)
+    position = literal_start = literal = 0
+    run = None  # [index, count] of the blocks being copied
+
+    while position < size:
+        length = min(block_size, size - position)
+        weak = zlib.adler32(data[position:position + length])
+        a, b = weak & 0xffff, weak >> 16
+        next_check = position + block_size
+        match = None
+
+        while True:
+            candidates = table.get((b << 16) | a)
+            if candidates is not None:
+                match = candidates.get(strong_hash(data[position:position + length]))
+                if match is not None:
+                    break
+
+            if position + length >= size:
+                break
+
+            if position >= next_check:
+                next_check += block_size
+                scanned = literal + position - literal_start
+                if scanned > SEARCH_BLOCKS * block_size and scanned * 2 > position:
+                    break
+
+            # Roll the window one byte forward
+            old, new = data[position], data[position + length]
+            a = (a - old + new) % ADLER_MOD
+            b = (b - length * old + a - 1) % ADLER_MOD
+            position += 1
+
+        if match is None:
+            # The new file may still end with the server's last block, which
+            # the rolling window misses when that block is short
+            match = tail_start = None
+            last = len(blocks) - 1
+            if last >= 0:
+                tail_start = size - (signature['size'] - last * block_size)
+                if literal_start <= tail_start < size and strong_hash(data[tail_start:]) == blocks[last][1]:
+                    match = last
+            if match is None:
+                break
+            position, length = tail_start, size - tail_start
+
+        if position > literal_start:
+            if run is not None:
+                yield ('copy', *run)
+                run = None
+            yield ('data', literal_start, position)
+            literal += position - literal_start
+
+        if run is not None and run[0] + run[1] == match:
+            run[1] += 1
+        else:
+            if run is not None:
+                yield ('copy', *run)
+            run = [match, 1]
+
+        position += length
+        literal_start = position
+
+    if run is not None:
+        yield ('copy', *run)
+    if literal_start < size:
+        yield ('data', literal_start, size)
+
+
+# Sends a file as a delta against the server's copy.
+#
+# Args:
+#     sock (socket.socket): The connected socket.
+#     data (bytes-like): The file's contents.
+#     signature (dict): From the server's FILE_STATUS.
+#
+# Returns:
+#     tuple: (bytes put on the wire, literal bytes among them)
+def send_delta(sock, data, signature):
+    sent = literal = 0
+    buffer = bytearray()
+
+    for op in compute_delta(data, signature):
+        if op[0] == 'copy':
+            buffer += encode_file_meta(copy=[op[1], op[2]])
+            continue
+
+        for start in range(op[1], op[2], BUFFER_SIZE):
+            end = min(start + BUFFER_SIZE, op[2])
+            buffer += encode_file_data_header(end - start)
+            buffer += data[start:end]
+            literal += end - start
+
+            if len(buffer) >= BUFFER_SIZE:
+                sock.sendall(buffer)
+                sent += len(buffer)
+                buffer.clear()
+
+    # An empty FILE_META ends the delta
+    buffer += encode_file_meta()
+    sock.sendall(buffer)
+    return sent + len(buffer), literal
+
+
+# Checks a copy instruction against the signature.
+#
+# Returns:
+#     tuple: (offset, length) of the bytes to copy from the server's copy.
+def parse_copy(op, signature):
+    try:
+        index, count = op['copy']
+    except (KeyError, TypeError, ValueError):
+        raise ProtocolError("Malformed delta instruction.")
+
+    if not isinstance(index, int) or not isinstance(count, int) or index < 0 or count < 1 or \
+            index + count > len(signature['blocks']):
+        raise ProtocolError("Delta refers to blocks the server does not have.")
+
+    offset = index * signature['block_size']
+    return offset, min(count * signature['block_size'], signature['size'] - offset)
+
+
+# Copies a byte range of the server's copy into the file being rebuilt.
+def copy_range(basis, writer, offset, length):
+    for chunk in read_range(basis, offset, length):
+        writer.write(chunk)
+
+
+# Receives a delta and rebuilds the file into writer.
+#
+# Args:
+#     sock (socket.socket): The connected socket.
+#     writer: Where the rebuilt file goes, e.g. a BatchEntry.
+#     basis: The Download of the server's copy the signature was made from.
+#     signature (dict): The signature sent to the client.
+#
+# Returns:
+#     int: Bytes received on the wire, including frame headers.
+def recv_delta(sock, writer, basis, signature):
+    received = 0
+
+    while True:
+        header = recv_header(sock)
+        if header is None:
+            raise ConnectionResetError("Connection closed in the middle of a delta.")
+
+        frame_type, length = header
+        received += HEADER.size + length
+
+        if frame_type == FRAME_FILE_META:
+            op = decode_file_meta(recv_exact(sock, length))
+            if not op:
+                return received
+            copy_range(basis, writer, *parse_copy(op, signature))
+
+        elif frame_type == FRAME_FILE_DATA:
+            while length > 0:
+                chunk = recv_exact(sock, min(BUFFER_SIZE, length))
+                writer.write(chunk)
+                length -= len(chunk)
+
+        else:
+            raise ProtocolError(f"Expected delta data, got frame type {frame_type}.")
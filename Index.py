@@ -0,0 +1,148 @@
+import bisect
+import fnmatch
+import threading
+import time
+from collections import namedtuple
+
+IndexEntry = namedtuple('IndexEntry', ['size', 'mtime', 'sha256'])
+
+SORT_KEYS = {
+    'name': lambda item: item[0],
+    'size': lambda item: (item[1].size, item[0]),
+    'mtime': lambda item: (item[1].mtime, item[0]),
+}
+
+
+# In-memory index of the files a storage backend holds, so /dir never has to
+# list or stat the storage folder and /get never has to rehash a file.
+#
+# Entries are added as uploads finish and refreshed by rescan(), which the
+# server runs at startup and then periodically from a background thread to
+# pick up files changed behind its back. Sorted views of the index are cached
+# until the next change, so paging through a large listing is a slice.
+#
+# Attributes:
+#     storage: The backend being indexed. It must provide list_files(),
+#         stat_file(name) -> (size, mtime) and compute_hash(name).
+#     entries (dict): filename -> IndexEntry
+class FileIndex:
+    def __init__(self, storage):
+        self.storage = storage
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.version = 0
+        self.sorted_views = {}  # sort key -> (version, sorted list of (name, entry))
+
+    def update(self, name, size, mtime, sha256):
+        with self.lock:
+            self.entries[name] = IndexEntry(size, mtime, sha256)
+            self.version += 1
+
+    def remove(self, name):
+        with self.lock:
+            if self.entries.pop(name, None) is not None:
+                self.version += 1
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns the sha256 of a file, hashing it only if the index has no hash
+    # for its current size and mtime.
+    def get_hash(self, name):
+        size, mtime = self.storage.stat_file(name)
+        entry = self.entries.get(name)
+        if entry and entry.sha256 and entry.size == size and entry.mtime == mtime:
+            return entry.sha256
+
+        sha256 = self.storage.compute_hash(name)
+        self.update(name, size, mtime, sha256)
+        return sha256
+
+    # Brings the index in line with the storage folder.
+    #
+    # Args:
+    #     hash_files (bool): Also hash new or changed files. A stat-only scan
+    #         is fast enough to run at startup; hashes are then filled in by
+    #         the next full scan or on the first /get.
+    def rescan(self, hash_files=True):
+        # Only entries that were already there when the folder was listed, and
+        # have not changed since, can be stale. One added by an upload that
+        # finished during the scan has to stay.
+        with self.lock:
+            before = dict(self.entries)
+        names = set(self.storage.list_files())
+
+        for name in names:
+            try:
+                size, mtime = self.storage.stat_file(name)
+                entry = self.entries.get(name)
+                if entry and entry.size == size and entry.mtime == mtime and (entry.sha256 or not hash_files):
+                    continue
+
+                sha256 = self.storage.compute_hash(name) if hash_files else None
+                self.update(name, size, mtime, sha256)
+
+            except OSError:
+                # Removed between listing and stat
+                names.discard(name)
+
+        with self.lock:
+            for name in set(before) - names:
+                if self.entries.get(name) is before[name]:
+                    del self.entries[name]
+                    self.version += 1
+
+    def start_rescan_thread(self, interval):
+        def run():
+            while True:
+                self.rescan()
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name='index-rescan', daemon=True)
+        thread.start()
+        return thread
+
+    def get_sorted(self, sort):
+        with self.lock:
+            cached = self.sorted_views.get(sort)
+            if cached and cached[0] == self.version:
+                return cached[1]
+
+            version = self.version
+            items = list(self.entries.items())
+
+        items.sort(key=SORT_KEYS[sort])
+        with self.lock:
+            self.sorted_views[sort] = (version, items)
+        return items
+
+    # Lists indexed files.
+    #
+    # Args:
+    #     prefix (str): Only names starting with this.
+    #     pattern (str): Only names matching this glob.
+    #     sort (str): 'name', 'size' or 'mtime'.
+    #     descending (bool): Reverse the sort order.
+    #
+    # Returns:
+    #     list: (name, IndexEntry) pairs.
+    def query(self, prefix='', pattern=None, sort='name', descending=False):
+        items = self.get_sorted(sort)
+
+        if prefix and sort == 'name':
+            # Names sharing a prefix are contiguous in name order
+            start = bisect.bisect_left(items, (prefix,))
+            end = start
+            while end < len(items) and items[end][0].startswith(prefix):
+                end += 1
+            items = items[start:end]
+        elif prefix:
+            items = [item for item in items if item[0].startswith(prefix)]
+
+        if pattern:
+            items = [item for item in items if fnmatch.fnmatchcase(item[0], pattern)]
+
+        return items[::-1] if descending else items
@@ -0,0 +1,286 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds, in seconds, of the command latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+# Server instrumentation.
+#
+# ServerMetrics is shared by every connection handler, writer and executor
+# thread, so all updates go through one lock; each is a handful of integer
+# additions. A server started without metrics gets a NullMetrics instead,
+# whose methods do nothing, so instrumented code never has to check.
+def create_metrics(enabled):
+    return ServerMetrics() if enabled else NullMetrics()
+
+
+# Latency histogram of one command.
+class CommandStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # the last one is +Inf
+
+    def add(self, seconds, error):
+        self.count += 1
+        self.total_seconds += seconds
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        if error:
+            self.errors += 1
+
+    # Upper bound, in milliseconds, of the bucket holding the given fraction of
+    # observations, or None if it is the +Inf bucket.
+    def quantile_ms(self, fraction):
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= target:
+                return bound * 1000
+        return None
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'sum_seconds': self.total_seconds,
+            'mean_ms': round(self.total_seconds / self.count * 1000, 3) if self.count else None,
+            'p50_ms': self.quantile_ms(0.5) if self.count else None,
+            'p99_ms': self.quantile_ms(0.99) if self.count else None,
+            'buckets': {str(bound): count for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), self.buckets)},
+        }
+
+
+# Bytes and time spent moving file data in one direction.
+class TransferStats:
+    def __init__(self):
+        self.transfers = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def to_dict(self):
+        return {
+            'transfers': self.transfers,
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 3),
+            'mb_per_s': round(self.bytes / self.seconds / 1e6, 2) if self.seconds else None,
+        }
+
+
+class ServerMetrics:
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.commands = {}  # command -> CommandStats
+        self.errors = {}  # kind -> count
+        self.transfers = {'in': TransferStats(), 'out': TransferStats()}
+        self.connections_active = 0
+        self.connections_total = 0
+        self.chat_messages = {}  # '/broadcast' or '/message' -> messages queued for recipients
+        self.chat_dropped = 0
+        self.gauges = {}  # name -> callable returning the current value
+
+    def add_gauge(self, name, function):
+        self.gauges[name] = function
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections_active += 1
+            self.connections_total += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections_active -= 1
+
+    # Records one handled command.
+    #
+    # Args:
+    #     command (str): The command name, e.g. '/get'.
+    #     started (float): time.perf_counter() when handling began.
+    #     error (bool): True if the command failed.
+    def record_command(self, command, started, error=False):
+        seconds = time.perf_counter() - started
+        with self.lock:
+            stats = self.commands.get(command)
+            if stats is None:
+                stats = self.commands[command] = CommandStats()
+            stats.add(seconds, error)
+
+    def record_error(self, kind):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    # Records file data moved over the wire.
+    #
+    # Args:
+    #     direction (str): 'in' for uploads, 'out' for downloads.
+    #     size (int): Bytes on the wire, after any compression.
+    #     started (float): time.perf_counter() when the transfer began.
+    def record_transfer(self, direction, size, started):
+        seconds = time.perf_counter() - started
+        with self.lock:
+            stats = self.transfers[direction]
+            stats.transfers += 1
+            stats.bytes += size
+            stats.seconds += seconds
+
+    def record_chat(self, command, recipients, dropped):
+        with self.lock:
+            self.chat_messages[command] = self.chat_messages.get(command, 0) + recipients
+            self.chat_dropped += dropped
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'uptime_seconds': round(time.time() - self.started, 1),
+                'connections': {'active': self.connections_active, 'total': self.connections_total},
+                'commands': {command: stats.to_dict() for command, stats in sorted(self.commands.items())},
+                'errors': dict(sorted(self.errors.items())),
+                'transfers': {direction: stats.to_dict() for direction, stats in self.transfers.items()},
+                'chat': {'messages': dict(self.chat_messages), 'dropped': self.chat_dropped},
+                'gauges': {name: function() for name, function in self.gauges.items()},
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    # Formats the metrics for /stats.
+    def to_text(self):
+        snapshot = self.snapshot()
+        connections = snapshot['connections']
+        lines = [f"Server Stats (up {snapshot['uptime_seconds']:.0f}s)",
+                 f"Connections: {connections['active']} active, {connections['total']} total"]
+
+        for name, value in snapshot['gauges'].items():
+            lines.append(f"{name.replace('_', ' ').capitalize()}: {value}")
+
+        for direction, label in [('in', 'Uploads'), ('out', 'Downloads')]:
+            stats = snapshot['transfers'][direction]
+            rate = f", {stats['mb_per_s']} MB/s while transferring" if stats['mb_per_s'] is not None else ''
+            lines.append(f"{label}: {stats['transfers']}, {stats['bytes'] / 1e6:.1f} MB{rate}")
+
+        chat = snapshot['chat']
+        lines.append(f"Chat: {sum(chat['messages'].values())} messages queued, {chat['dropped']} dropped")
+
+        if snapshot['errors']:
+            lines.append("Errors: " + ', '.join(f"{kind} {count}" for kind, count in snapshot['errors'].items()))
+
+        for command, stats in snapshot['commands'].items():
+            lines.append(f"{command}: {stats['count']} handled, {stats['errors']} failed, mean {stats['mean_ms']} ms, "
+                         f"p50 <= {stats['p50_ms']} ms, p99 <= {stats['p99_ms']} ms")
+
+        return '\n'.join(lines)
+
+    # Formats the metrics in the Prometheus text exposition format.
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = [
+            '# TYPE fileexchange_uptime_seconds gauge',
+            f"fileexchange_uptime_seconds {snapshot['uptime_seconds']}",
+            '# TYPE fileexchange_connections_active gauge',
+            f"fileexchange_connections_active {snapshot['connections']['active']}",
+            '# TYPE fileexchange_connections_total counter',
+            f"fileexchange_connections_total {snapshot['connections']['total']}",
+        ]
+
+        for name, value in snapshot['gauges'].items():
+            lines += [f'# TYPE fileexchange_{name} gauge', f'fileexchange_{name} {value}']
+
+        lines.append('# TYPE fileexchange_command_duration_seconds histogram')
+        for command, stats in snapshot['commands'].items():
+            cumulative = 0
+            for bound, count in stats['buckets'].items():
+                cumulative += count
+                lines.append(f'fileexchange_command_duration_seconds_bucket{{command="{command}",le="{bound}"}} {cumulative}')
+            lines.append(f'fileexchange_command_duration_seconds_sum{{command="{command}"}} {stats["sum_seconds"]}')
+            lines.append(f'fileexchange_command_duration_seconds_count{{command="{command}"}} {stats["count"]}')
+
+        lines.append('# TYPE fileexchange_command_errors_total counter')
+        for command, stats in snapshot['commands'].items():
+            lines.append(f'fileexchange_command_errors_total{{command="{command}"}} {stats["errors"]}')
+
+        lines.append('# TYPE fileexchange_errors_total counter')
+        for kind, count in snapshot['errors'].items():
+            lines.append(f'fileexchange_errors_total{{kind="{kind}"}} {count}')
+
+        for metric, field in [('transfers_total', 'transfers'), ('bytes_total', 'bytes'),
+                              ('transfer_seconds_total', 'seconds')]:
+            lines.append(f'# TYPE fileexchange_{metric} counter')
+            for direction, stats in snapshot['transfers'].items():
+                lines.append(f'fileexchange_{metric}{{direction="{direction}"}} {stats[field]}')
+
+        lines.append('# TYPE fileexchange_chat_messages_total counter')
+        for command, count in snapshot['chat']['messages'].items():
+            lines.append(f'fileexchange_chat_messages_total{{command="{command}"}} {count}')
+        lines += ['# TYPE fileexchange_chat_dropped_total counter',
+                  f"fileexchange_chat_dropped_total {snapshot['chat']['dropped']}"]
+
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetrics:
+    enabled = False
+
+    def add_gauge(self, name, function):
+        pass
+
+    def connection_opened(self):
+        pass
+
+    def connection_closed(self):
+        pass
+
+    def record_command(self, command, started, error=False):
+        pass
+
+    def record_error(self, kind):
+        pass
+
+    def record_transfer(self, direction, size, started):
+        pass
+
+    def record_chat(self, command, recipients, dropped):
+        pass
+
+
+# Serves the metrics over HTTP: /metrics in the Prometheus text format and
+# /metrics.json as JSON. Runs on a daemon thread.
+#
+# Args:
+#     metrics (ServerMetrics): The metrics to serve.
+#     host (str): Address to listen on; keep this local.
+#     port (int): Port to listen on.
+#
+# Returns:
+#     ThreadingHTTPServer: The running server.
+def start_metrics_server(metrics, host, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = metrics.to_prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = metrics.to_json(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=http_server.serve_forever, name='metrics-http', daemon=True).start()
+    return http_server
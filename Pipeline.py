@@ -0,0 +1,118 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from Protocol import ProtocolError
+
+# Write-behind for uploads.
+#
+# A storage backend with a pipeline hands out BufferedUploads. The thread
+# reading an upload off the network only queues what it receives, and a pool
+# of disk writer threads applies it to the real Upload in order. The socket
+# keeps being read while the disk catches up, and a slow disk only holds the
+# reader back once buffer_size bytes of the upload are waiting.
+#
+# Disk errors are kept until finish, which waits for everything queued and
+# reports them to the client instead of storing the file. Anything queued
+# after an error is dropped.
+
+# Bytes of an upload that may be waiting for the disk.
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+# Args:
+#     workers (int): Disk writer threads shared by all uploads.
+#     buffer_size (int): Bytes each upload may have waiting.
+class UploadPipeline:
+    def __init__(self, workers=4, buffer_size=WRITE_BUFFER_SIZE):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='disk-writer')
+        self.buffer_size = buffer_size
+
+    def wrap(self, upload):
+        return BufferedUpload(upload, self.executor, self.buffer_size)
+
+
+# An Upload whose start_range, write and end_range run on the disk writers.
+class BufferedUpload:
+    def __init__(self, upload, executor, buffer_size):
+        self.upload = upload
+        self.filename = upload.filename
+        self.ranges = upload.ranges
+        self.executor = executor
+        self.buffer_size = buffer_size
+        self.condition = threading.Condition()
+        self.operations = deque()  # (function, args, size)
+        self.buffered = 0
+        self.scheduled = False  # a writer has the queue or is about to
+        self.error = None
+
+    def queue(self, function, *args, size=0):
+        with self.condition:
+            while self.buffered and self.buffered + size > self.buffer_size and self.error is None:
+                self.condition.wait()
+
+            if self.error is not None:
+                return
+
+            self.operations.append((function, args, size))
+            self.buffered += size
+            if not self.scheduled:
+                self.scheduled = True
+                self.executor.submit(self.drain)
+
+    # Runs what is queued so far, then goes to the back of the pool's queue if
+    # more has arrived, so a fast upload cannot keep a writer to itself.
+    def drain(self):
+        with self.condition:
+            operations, self.operations = self.operations, deque()
+
+        for function, args, size in operations:
+            try:
+                function(*args)
+            except Exception as e:  # anything, or finish would wait forever
+                with self.condition:
+                    self.error = e
+                    self.operations.clear()
+                    self.buffered = 0
+                    self.scheduled = False
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                self.buffered -= size
+                self.condition.notify_all()
+
+        with self.condition:
+            if self.operations:
+                self.executor.submit(self.drain)
+            else:
+                self.scheduled = False
+                self.condition.notify_all()
+
+    def wait(self):
+        with self.condition:
+            while self.scheduled:
+                self.condition.wait()
+
+    def start_range(self, offset, length):
+        self.queue(self.upload.start_range, offset, length)
+
+    def write(self, data):
+        # Callers may reuse their buffer once this returns
+        self.queue(self.upload.write, bytes(data), size=len(data))
+
+    def end_range(self):
+        self.queue(self.upload.end_range)
+
+    def close(self):
+        self.wait()
+        self.upload.close()
+
+    # Returns:
+    #     str: An error message for the client, or None if the file was stored.
+    def finish(self):
+        self.wait()
+        if isinstance(self.error, ProtocolError):
+            return f"Error: {self.error} {self.filename} was discarded."
+        if self.error is not None:
+            return f"Error: Could not write {self.filename}: {getattr(self.error, 'strerror', None) or self.error}."
+        return self.upload.finish()
@@ -0,0 +1,321 @@
+import asyncio
+import hashlib
+import json
+import struct
+
+
+# Wire protocol shared by FileExchangeServer and FileExchangeClient.
+#
+# Every message on the connection is a frame: a fixed 10-byte header followed
+# by exactly `length` bytes of payload. The header is
+#
+#     version (uint8) | frame type (uint8) | payload length (uint64), big-endian
+#
+# so a receiver always knows how many bytes to read and never has to scan the
+# stream for a marker. File contents travel as a single FILE_DATA frame whose
+# length is the file size, preceded by a FILE_META frame naming the file.
+#
+# An upload is COMMAND "/store <name>", then FILE_META {filename, size, sha256,
+# chunks} from the client, FILE_STATUS {ranges} from the server listing the
+# [offset, length] byte ranges it still needs, one FILE_DATA frame per range,
+# in order, and finally FILE_STATUS {stored, error} from the server once the
+# file is verified. A download is FILE_META {filename, size, offset, length,
+# sha256} followed by FILE_DATA with length bytes starting at offset.
+# Batches of files (/mstore, /mget) reuse these frames; see Batch.py. So do
+# delta uploads of files the server already has a copy of; see Delta.py.
+PROTOCOL_VERSION = 1
+
+FRAME_COMMAND = 1    # utf-8 command line sent by a client, e.g. "/get notes.txt"
+FRAME_MESSAGE = 2    # utf-8 server response or error
+FRAME_FILE_META = 3  # utf-8 JSON object describing the file that follows
+FRAME_FILE_DATA = 4  # raw file contents
+FRAME_FILE_STATUS = 5  # utf-8 JSON the server sends back after an upload's FILE_META
+FRAME_CHAT = 6       # utf-8 chat from another client or a notice, which may arrive between any two replies
+
+HEADER = struct.Struct('!BBQ')
+
+# Buffer used when streaming file contents to and from disk.
+BUFFER_SIZE = 1024 * 1024
+
+# Largest payload accepted for anything other than FILE_DATA. Keeps a bad or
+# hostile peer from making us allocate an arbitrary amount of memory, while
+# leaving room for the chunk list of a file of several hundred GB.
+MAX_CONTROL_LENGTH = 8 * 1024 * 1024
+
+# Uploads list the sha256 of every CHUNK_SIZE piece of the file so that a
+# deduplicating server can ask for only the chunks it does not have yet.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Builds the bytes of a complete frame.
+#
+# Args:
+#     frame_type (int): One of the FRAME_* constants.
+#     payload (bytes): The frame payload.
+#
+# Returns:
+#     bytes: Header and payload, ready to be written to a socket.
+def encode_frame(frame_type, payload=b''):
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, len(payload)) + payload
+
+
+# Parses a frame header.
+#
+# Args:
+#     header (bytes): Exactly HEADER.size bytes.
+#
+# Returns:
+#     tuple: (frame_type, length)
+def decode_header(header):
+    version, frame_type, length = HEADER.unpack(header)
+
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+
+    if frame_type != FRAME_FILE_DATA and length > MAX_CONTROL_LENGTH:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the control frame limit")
+
+    return frame_type, length
+
+
+def send_frame(sock, frame_type, payload=b''):
+    sock.sendall(encode_frame(frame_type, payload))
+
+
+def send_command(sock, command):
+    send_frame(sock, FRAME_COMMAND, command.encode('utf-8'))
+
+
+def send_message(sock, message):
+    send_frame(sock, FRAME_MESSAGE, message.encode('utf-8'))
+
+
+def send_file_meta(sock, **meta):
+    sock.sendall(encode_file_meta(**meta))
+
+
+def encode_file_meta(**meta):
+    return encode_frame(FRAME_FILE_META, json.dumps(meta).encode('utf-8'))
+
+
+def send_file_status(sock, **status):
+    sock.sendall(encode_file_status(**status))
+
+
+def encode_file_status(**status):
+    return encode_frame(FRAME_FILE_STATUS, json.dumps(status).encode('utf-8'))
+
+
+# Header of a FILE_DATA frame; the caller sends the size bytes that follow.
+def encode_file_data_header(size):
+    return HEADER.pack(PROTOCOL_VERSION, FRAME_FILE_DATA, size)
+
+
+# Reads exactly n bytes from a socket.
+#
+# Raises:
+#     ConnectionResetError: If the peer closes the connection first.
+def recv_exact(sock, n):
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    received = 0
+
+    while received < n:
+        count = sock.recv_into(view[received:], n - received)
+        if count == 0:
+            raise ConnectionResetError("Connection closed in the middle of a frame.")
+        received += count
+
+    return bytes(buffer)
+
+
+# Reads the next frame header.
+#
+# Returns:
+#     tuple: (frame_type, length), or None if the peer closed the connection
+#     cleanly between frames.
+def recv_header(sock):
+    first = sock.recv(HEADER.size)
+    if not first:
+        return None
+
+    if len(first) < HEADER.size:
+        first += recv_exact(sock, HEADER.size - len(first))
+
+    return decode_header(first)
+
+
+# Reads the next complete control frame. FILE_DATA frames are not read by this
+# function since they can be arbitrarily large; use recv_file_data instead.
+#
+# Returns:
+#     tuple: (frame_type, payload), or None on a clean close.
+def recv_frame(sock):
+    header = recv_header(sock)
+    if header is None:
+        return None
+
+    frame_type, length = header
+    if frame_type == FRAME_FILE_DATA:
+        raise ProtocolError("Unexpected file data frame.")
+
+    return frame_type, recv_exact(sock, length)
+
+
+def decode_file_meta(payload):
+    try:
+        meta = json.loads(payload.decode('utf-8'))
+    except ValueError:
+        raise ProtocolError("Malformed file metadata.")
+
+    if not isinstance(meta, dict):
+        raise ProtocolError("Malformed file metadata.")
+
+    return meta
+
+
+# Sends the contents of an open file as one FILE_DATA frame.
+#
+# The payload goes through socket.sendfile, which hands the copy to the kernel
+# (os.sendfile) where the platform supports it and otherwise falls back to a
+# read/send loop with BUFFER_SIZE chunks.
+#
+# Args:
+#     sock (socket.socket): The connected, blocking socket.
+#     file (file object): A file opened in binary mode.
+#     size (int): Number of bytes to send.
+#     offset (int): Position in the file to start sending from.
+def send_file_data(sock, file, size, offset=0):
+    sock.sendall(encode_file_data_header(size))
+    sendfile_exact(sock, file, offset, size)
+
+
+# Sends count bytes of a file starting at offset, without a frame header.
+def sendfile_exact(sock, file, offset, count):
+    if count == 0:
+        return
+
+    sent = sock.sendfile(file, offset, count)
+    if sent != count:
+        raise ProtocolError("File shrank while it was being sent.")
+
+
+# Receives one FILE_DATA frame and writes its contents to an open file.
+#
+# Args:
+#     sock (socket.socket): The connected socket.
+#     file (file object): A file opened for binary writing.
+#     digest (hashlib hash): Optional hash updated with every byte received.
+#
+# Returns:
+#     int: Number of bytes written.
+def recv_file_data(sock, file, digest=None):
+    header = recv_header(sock)
+    if header is None:
+        raise ConnectionResetError("Connection closed before file data was received.")
+
+    frame_type, length = header
+    if frame_type != FRAME_FILE_DATA:
+        raise ProtocolError(f"Expected file data, got frame type {frame_type}.")
+
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    remaining = length
+
+    while remaining > 0:
+        count = sock.recv_into(view, min(BUFFER_SIZE, remaining))
+        if count == 0:
+            raise ConnectionResetError("Connection closed in the middle of a file transfer.")
+        file.write(view[:count])
+        if digest is not None:
+            digest.update(view[:count])
+        remaining -= count
+
+    return length
+
+
+# Hashes the start of a file.
+#
+# Args:
+#     path (str): The file to read.
+#     length (int): Number of bytes to hash, or None for the whole file.
+#     digest (hashlib hash): Hash to update instead of starting a new sha256.
+#
+# Returns:
+#     hashlib hash: A sha256 object that can be updated further, e.g. with the
+#     rest of a file that is still being transferred.
+def hash_file(path, length=None, digest=None):
+    if digest is None:
+        digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        while length is None or length > 0:
+            chunk = file.read(BUFFER_SIZE if length is None else min(BUFFER_SIZE, length))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if length is not None:
+                length -= len(chunk)
+
+    return digest
+
+
+# Hashes a whole file and each CHUNK_SIZE chunk of it in a single pass.
+#
+# Returns:
+#     tuple: (sha256 hex of the file, list of sha256 hex of each chunk)
+def hash_file_chunks(path):
+    digest = hashlib.sha256()
+    chunks = []
+
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            chunks.append(hashlib.sha256(chunk).hexdigest())
+
+    return digest.hexdigest(), chunks
+
+
+def is_sha256(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+# asyncio counterparts of the helpers above, used by the server's asyncio
+# engine. They operate on asyncio.StreamReader objects; writing is just
+# writer.write(encode_frame(...)) followed by a drain.
+
+async def read_exact(reader, n):
+    try:
+        return await reader.readexactly(n)
+    except asyncio.IncompleteReadError:
+        raise ConnectionResetError("Connection closed in the middle of a frame.")
+
+
+async def read_header(reader):
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionResetError("Connection closed in the middle of a frame.")
+
+    return decode_header(header)
+
+
+async def read_frame(reader):
+    header = await read_header(reader)
+    if header is None:
+        return None
+
+    frame_type, length = header
+    if frame_type == FRAME_FILE_DATA:
+        raise ProtocolError("Unexpected file data frame.")
+
+    return frame_type, await read_exact(reader, length)
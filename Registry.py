@@ -0,0 +1,89 @@
+import threading
+
+
+# Registered clients, looked up in constant time by handle or by the peer
+# address of their connection.
+#
+# All changes happen under one lock, so checking that a handle is free and
+# claiming it is a single atomic step even when many handler threads register
+# at once. Broadcasts iterate over a snapshot that is rebuilt only after the
+# registry changes, so fan-out never holds the lock or copies the map per
+# message.
+class ClientRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_handle = {}  # handle -> connection
+        self.by_address = {}  # (ip, port) -> handle
+        self.snapshot = None
+
+    # Registers a connection under a handle.
+    #
+    # Args:
+    #     handle (str): The requested handle.
+    #     connection: The client's connection; must have an address attribute.
+    #
+    # Returns:
+    #     bool: False if the handle is already taken.
+    def register(self, handle, connection):
+        with self.lock:
+            if handle in self.by_handle:
+                return False
+
+            self.by_handle[handle] = connection
+            self.by_address[connection.address] = handle
+            self.snapshot = None
+            return True
+
+    # Removes a connection if it is registered.
+    #
+    # Returns:
+    #     str: The handle it was registered under, or None.
+    def unregister(self, connection):
+        with self.lock:
+            handle = self.by_address.get(connection.address)
+            if handle is None or self.by_handle.get(handle) is not connection:
+                return None
+
+            del self.by_address[connection.address]
+            del self.by_handle[handle]
+            self.snapshot = None
+            return handle
+
+    def get(self, handle):
+        return self.by_handle.get(handle)
+
+    def get_handle(self, connection):
+        handle = self.by_address.get(connection.address)
+        if handle is not None and self.by_handle.get(handle) is connection:
+            return handle
+        return None
+
+    def get_by_address(self, address):
+        handle = self.by_address.get(address)
+        return None if handle is None else self.by_handle.get(handle)
+
+    # Chat for a handle that is not registered here. Only a worker in
+    # multi-process mode has anywhere to send it; see ClusterRegistry.
+    #
+    # Returns:
+    #     bool: True if the handle is registered elsewhere.
+    def forward_message(self, handle, message):
+        return False
+
+    def forward_broadcast(self, message):
+        pass
+
+    def __contains__(self, handle):
+        return handle in self.by_handle
+
+    def __len__(self):
+        return len(self.by_handle)
+
+    # Returns:
+    #     tuple: Every registered connection, as of the last change.
+    def connections(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.snapshot = tuple(self.by_handle.values())
+        return snapshot
@@ -1,193 +1,1362 @@
+import argparse
+import asyncio
+import functools
 import socket
 import threading
-import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import time
+from Protocol import (BUFFER_SIZE, FRAME_CHAT, FRAME_COMMAND, FRAME_FILE_DATA, FRAME_FILE_META, FRAME_MESSAGE, HEADER, ProtocolError,
+                      decode_file_meta, encode_file_data_header, encode_file_meta, encode_file_status, encode_frame,
+                      read_exact, read_frame, read_header, recv_frame, recv_file_data, send_file_status,
+                      send_message, sendfile_exact)
+from Batch import BatchEntry, is_valid_filename
+from Cache import CachedDownload, FileCache
+from Cluster import ClusterLink, ClusterRegistry, run_workers
+from Delta import DELTA_MIN_SIZE, compute_signature, copy_range, parse_copy, recv_delta
+from Compression import (CODECS, DecompressingWriter, choose_codec, compress_frames, is_compressible, offered_codecs,
+                         parse_codecs, read_sample, recv_compressed_data)
+from Connection import SLOW_CLIENT_POLICIES, AsyncClientConnection, ClientConnection
+from Index import SORT_KEYS
+from Metrics import create_metrics, start_metrics_server
+from Pipeline import WRITE_BUFFER_SIZE, UploadPipeline
+from Registry import ClientRegistry
+from Shaping import QUANTUM, TokenBucket
+from Storage import DURABILITY_MODES, STORAGES, create_storage
+
+ENGINES = ['threaded', 'asyncio']
+
+# /dir pagination
+DIR_PAGE_SIZE = 100
+DIR_MAX_PAGE_SIZE = 10000
+DIR_LINES_PER_MESSAGE = 500
+DIR_USAGE = "Error: Usage is /dir [prefix=<text>] [match=<glob>] [sort=name|size|mtime] [order=asc|desc] [page=<n>] [limit=<n>]"
+
+# Seconds spent telling a client turned away by --max-connections why.
+REJECT_TIMEOUT = 1
 
 class FileExchangeServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, engine='threaded', file_workers=4, storage='plain', rescan_interval=60,
+                 slow_client_policy='drop', metrics=True, metrics_host='localhost', metrics_port=None, cache_size=0,
+                 cache_max_file_size=None, rate_limit=0, client_rate_limit=0, max_connections=0, idle_timeout=0,
+                 durability='none', disk_writers=4, write_buffer_size=WRITE_BUFFER_SIZE, cluster_path=None,
+                 worker_id=0):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+
         self.host = host
         self.port = port
+        self.engine = engine
+        self.file_workers = file_workers
+        self.slow_client_policy = slow_client_policy
+
+        # Outgoing transfers share rate_limit bytes/s between all clients, and
+        # each client gets at most client_rate_limit; 0 means unlimited
+        self.rate_bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.client_rate_limit = client_rate_limit
+
+        # Admission control: connections beyond max_connections are turned
+        # away, and clients idle for idle_timeout seconds are disconnected
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout or None
+        self.connection_count = 0
+        self.connection_lock = threading.Lock()
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients = []  # (ip, port, handle)
-        self.client_sockets = {}
-        self.files = []
+        self.loop = None  # the event loop under asyncio
+        self.worker_id = worker_id
+
+        # In multi-process mode every worker listens on the same port, and the
+        # coordinator keeps handles unique across them
+        if cluster_path is not None:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.cluster = ClusterLink(cluster_path)
+            self.cluster.on_deliver = self.receive_forwarded
+            self.cluster.on_file = self.receive_file_update
+            self.registry = ClusterRegistry(self.cluster)
+        else:
+            self.cluster = None
+            self.registry = ClientRegistry()  # registered ClientConnections, or AsyncClientConnections under asyncio
         self.folder_path = 'Server_Files'
+
+        # Uploads are written to disk behind the network by disk_writers
+        # threads, or by the receiving thread itself with 0
+        self.pipeline = UploadPipeline(disk_writers, write_buffer_size) if disk_writers else None
+        self.storage = create_storage(storage, self.folder_path, durability, self.pipeline)
+
+        # A quick stat-only pass makes /dir complete right away; the rescan
+        # thread then fills in hashes and keeps picking up outside changes.
+        self.storage.index.rescan(hash_files=False)
+        if rescan_interval:
+            self.storage.index.start_rescan_thread(rescan_interval)
+
+        self.metrics = create_metrics(metrics or metrics_port is not None)
+        self.metrics.add_gauge('registered_clients', lambda: len(self.registry))
+        self.metrics.add_gauge('indexed_files', lambda: len(self.storage.index))
+
+        # Optional in-memory copies of recently fetched files
+        self.cache = FileCache(cache_size, cache_max_file_size) if cache_size else None
+        if self.cache is not None:
+            self.metrics.add_gauge('cache_bytes', lambda: self.cache.size)
+            self.metrics.add_gauge('cache_hits', lambda: self.cache.hits)
+            self.metrics.add_gauge('cache_misses', lambda: self.cache.misses)
+            self.metrics.add_gauge('cache_evictions', lambda: self.cache.evictions)
+        if metrics_port is not None:
+            # Each worker serves its own metrics, on the next port up
+            start_metrics_server(self.metrics, metrics_host, metrics_port + worker_id)
+
         self.start_server()
 
     def start_server(self):
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen()
 
-        print(f"Server is listening on {self.host}:{self.port}")
+        worker = f", worker {self.worker_id}" if self.cluster is not None else ''
+        print(f"Server is listening on {self.host}:{self.port} ({self.engine} engine{worker})")
+
+        if self.engine == 'asyncio':
+            asyncio.run(self.serve_async())
+            return
 
         while True:
             client_socket, client_address = self.server_socket.accept()
+            if not self.admit_connection():
+                self.reject_connection(client_socket)
+                continue
+
             print(f"Accepted connection from {client_address}")
 
             client_thread = threading.Thread(target=self.handle_client, args=(client_socket,))
             client_thread.start()
 
+    # Counts a new connection unless the server is full.
+    #
+    # Returns:
+    #     bool: False if the connection should be turned away.
+    def admit_connection(self):
+        with self.connection_lock:
+            if self.max_connections and self.connection_count >= self.max_connections:
+                self.metrics.record_error('rejected')
+                return False
+            self.connection_count += 1
+            return True
+
+    def release_connection(self):
+        with self.connection_lock:
+            self.connection_count -= 1
+
+    def reject_connection(self, client_socket):
+        try:
+            client_socket.settimeout(REJECT_TIMEOUT)
+            send_message(client_socket, "Error: The server is full. Try again later.")
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+
+    # Token buckets for a new connection's transfers.
+    def connection_buckets(self):
+        buckets = [TokenBucket(self.client_rate_limit)] if self.client_rate_limit else []
+        if self.rate_bucket is not None:
+            buckets.append(self.rate_bucket)
+        return buckets
+
+    # Waits for the client's next frame without consuming any of it.
+    #
+    # Returns:
+    #     bool: False once the client has been idle for idle_timeout seconds.
+    #     Time spent receiving a transfer from the server does not count.
+    def wait_for_command(self, connection):
+        while True:
+            try:
+                connection.sock.recv(1, socket.MSG_PEEK)
+                return True
+            except socket.timeout:
+                if connection.is_idle():
+                    return False
+
     def is_command(self, client_socket, input):
             command, *args = input.split()
             
-            if (command in ['/leave', '/dir', '/?'] and len(args) == 0) or (command in ['/register', '/store', '/get'] and len(args) == 1) or (command == '/join' and len(args) == 2) or (command in ['/broadcast', '/message']):
+            if (command in ['/leave', '/?'] and len(args) == 0) or (command in ['/register', '/store'] and len(args) == 1) or (command == '/get' and 1 <= len(args) <= 4) or (command == '/join' and len(args) == 2) or (command == '/stats' and len(args) <= 1) or (command == '/mstore' and len(args) == 0) or (command == '/mget' and len(args) >= 1) or (command in ['/dir', '/broadcast', '/message']):
                 return True
 
-            elif (command in ['/leave', '/dir', '/?'] and len(args) != 0) or (command in ['/register', '/store', '/get'] and len(args) != 1) or (command == '/join' and len(args) != 2):
-                client_socket.send("Error: Command parameters do not match or is not allowed.".encode('utf-8'))
+            elif (command in ['/leave', '/?'] and len(args) != 0) or (command in ['/register', '/store'] and len(args) != 1) or (command == '/get' and not 1 <= len(args) <= 4) or (command == '/join' and len(args) != 2) or (command == '/stats' and len(args) > 1) or (command == '/mstore' and len(args) != 0) or (command == '/mget' and len(args) == 0):
+                self.metrics.record_error('bad_command')
+                self.deliver_message(client_socket, "Error: Command parameters do not match or is not allowed.")
                 return False
 
             else:
-                client_socket.send("Error: Command not found.".encode('utf-8'))
+                self.metrics.record_error('bad_command')
+                self.deliver_message(client_socket, "Error: Command not found.")
                 return False    
             
     def handle_client(self, client_socket):
-        while True:
-            try:
-                data = client_socket.recv(1024).decode('utf-8')
-                if not data:
-                    break
-                
-                if self.is_command(client_socket, data) == False:
-                    break
+        try:
+            # The timeout also cuts off a client that stalls in the middle of
+            # a frame or stops reading what is sent to it
+            client_socket.settimeout(self.idle_timeout)
+            connection = ClientConnection(client_socket, self.slow_client_policy, buckets=self.connection_buckets())
+        except OSError:
+            client_socket.close()
+            self.release_connection()
+            return
+
+        self.metrics.connection_opened()
+
+        try:
+            while True:
+                try:
+                    connection.wait_for_room()
 
-                command, *args = data.split()
+                    if self.idle_timeout is not None and not self.wait_for_command(connection):
+                        self.metrics.record_error('idle_timeout')
+                        self.deliver_message(connection, f"Disconnected after {self.idle_timeout:g} seconds of inactivity.")
+                        break
+
+                    frame = recv_frame(client_socket)
+                    if frame is None:
+                        break
+
+                    frame_type, payload = frame
+                    if frame_type != FRAME_COMMAND:
+                        self.deliver_message(connection, "Error: Expected a command.")
+                        continue
+
+                    data = payload.decode('utf-8')
+                    if not data.strip():
+                        continue
                 
-                if command == '/join':
-                    client_socket.send("Error: You are already connected to the server.".encode('utf-8'))
+                    if self.is_command(connection, data) == False:
+                        break
+
+                    command, *args = data.split()
+                    started = time.perf_counter()
+                    failed = False
                 
-                elif command == '/leave':
-                    client_socket.send("Connection closed. Thank you!".encode('utf-8'))
-                    time.sleep(0.1)
-                    self.remove_client(client_socket)
-                    client_socket.close()
-                    break
+                    if command == '/leave':
+                        self.deliver_message(connection, "Connection closed. Thank you!")
+                        break
 
-                elif command == '/register':
-                    handle = args[0]
-                    if self.is_handle_unique(handle):
-                        self.register_client(client_socket, handle)
-                    else:
-                        client_socket.send("Error: Handle or alias already exists.".encode('utf-8'))
+                    elif command == '/store':
+                        filename = args[0]
+                        failed = not self.receive_file(connection, filename)
 
-                elif command == '/store':
-                    filename = args[0]
-                    self.receive_file(client_socket, filename)
-                    
-                elif command == '/dir':
-                    file_list = self.get_directory_listing()
-                    client_socket.send(file_list.encode('utf-8'))
+                    elif command == '/mstore':
+                        failed = not self.receive_batch(connection)
                     
-                elif command == '/get':
-                    filename = args[0]
-                    self.send_file(client_socket, filename)
+                    elif command == '/dir':
+                        for file_list in self.get_directory_listing(args):
+                            self.deliver_message(connection, file_list)
                     
-                elif command == '/?':
-                    self.print_help(client_socket)
-                    
-                elif command == '/broadcast':
-                    message = ' '.join(args)
-                    self.broadcast_message(f"Broadcast from {handle}: {message}")
-
-                elif command == '/message':
-                    recipient_handle = args[0]
-                    message = ' '.join(args[1:])
-                    self.unicast_message(recipient_handle, f"Message from {handle}: {message}")
+                    elif command == '/get':
+                        # Runs on the connection's writer thread, in order with
+                        # everything else queued for this client
+                        filename = args[0]
+                        connection.put(functools.partial(self.send_file, filename=filename, range_args=args[1:]))
+                        continue  # the transfer job records its own latency
+
+                    elif command == '/mget':
+                        connection.put(functools.partial(self.send_batch, patterns=args))
+                        continue
+
+                    else:
+                        self.handle_chat_command(connection, command, args)
+
+                    self.metrics.record_command(command, started, failed)
                     
-            except ConnectionResetError:
-                break
+                except OSError:
+                    self.metrics.record_error('connection')
+                    break
+
+                except (ProtocolError, UnicodeDecodeError):
+                    self.metrics.record_error('protocol')
+                    break
+
+        finally:
+            self.remove_client(connection)
+            connection.flush_and_close()
+            self.metrics.connection_closed()
+            self.release_connection()
+
+    # Handles the commands that only exchange short messages and never touch
+    # the file system, so both engines can share them.
+    #
+    # Args:
+    #     connection: The client's ClientConnection or AsyncClientConnection.
+    #     command (str): The command name.
+    #     args (list): The command arguments.
+    def handle_chat_command(self, connection, command, args):
+        if command == '/join':
+            self.deliver_message(connection, "Error: You are already connected to the server.")
+
+        elif command == '/register':
+            handle = args[0]
+            if self.get_handle(connection) is not None:
+                self.deliver_message(connection, "Error: You are already registered with the server.")
+            elif not self.register_client(connection, handle):
+                self.deliver_message(connection, "Error: Handle or alias already exists.")
+
+        elif command == '/?':
+            self.print_help(connection)
+
+        elif command == '/stats':
+            if not self.metrics.enabled:
+                self.deliver_message(connection, "Error: Metrics are disabled on this server.")
+            elif args == ['json']:
+                self.deliver_message(connection, self.metrics.to_json())
+            else:
+                self.deliver_message(connection, self.metrics.to_text())
+
+        elif command in ['/broadcast', '/message']:
+            handle = self.get_handle(connection)
+            if handle is None:
+                self.deliver_message(connection, "Error: You are not registered with the server.")
+
+            elif command == '/broadcast':
+                message = ' '.join(args)
+                self.broadcast_message(f"Broadcast from {handle}: {message}", sender=connection)
+
+            elif not args:
+                self.deliver_message(connection, "Error: Usage is /message <handle> <message>.")
+
+            else:
+                recipient_handle = args[0]
+                message = ' '.join(args[1:])
+                if self.unicast_message(recipient_handle, f"Message from {handle}: {message}"):
+                    self.deliver_message(connection, f"Message to {recipient_handle}: {message}")
+                else:
+                    self.deliver_message(connection, f"Error: No client is registered as {recipient_handle}.")
+
+    # Queues a reply for a client on either engine.
+    #
+    # Args:
+    #     connection: The client's ClientConnection or AsyncClientConnection.
+    #     message (str): The message text.
+    def deliver_message(self, connection, message):
+        return connection.put(encode_frame(FRAME_MESSAGE, message.encode('utf-8')))
+
+    # Queues chat from another client. It goes out as a CHAT frame, so that
+    # clients never take it for a reply, and the slow client policy may
+    # discard it.
+    def deliver_chat(self, connection, message):
+        return connection.put(encode_frame(FRAME_CHAT, message.encode('utf-8')), droppable=True)
+
+    def get_handle(self, connection):
+        return self.registry.get_handle(connection)
 
     def is_handle_unique(self, handle):
-        for client in self.clients:
-            if handle == client[2]:
-                return False
-        return True
+        return handle not in self.registry
 
     def register_client(self, client_socket, handle):
-        client_address = client_socket.getpeername()
-        self.clients.append((client_address[0], client_address[1], handle))
-        self.client_sockets[handle] = client_socket
-        
-        client_socket.send(f"Welcome {handle}!".encode('utf-8'))
+        if not self.registry.register(handle, client_socket):
+            return False
+
+        self.deliver_message(client_socket, f"Welcome {handle}!")
+        return True
 
     def remove_client(self, client_socket):
-        client_address = client_socket.getpeername()
-        for client in self.clients:
-            if client[0] == client_address[0] and client[1] == client_address[1]:
-                self.clients.remove(client)
+        self.registry.unregister(client_socket)
+
+    # Handles an upload.
+    #
+    # Returns:
+    #     bool: True if the file was stored.
+    def receive_file(self, connection, filename):
+        client_socket = connection.sock
+        frame = recv_frame(client_socket)
+        if frame is None:
+            raise ConnectionResetError("Connection closed before the file was sent.")
+
+        frame_type, payload = frame
+        if frame_type != FRAME_FILE_META:
+            self.deliver_message(connection, "Error: Expected file metadata.")
+            return False
+
+        # The storage backend decides which byte ranges it still needs, e.g.
+        # only the tail of an interrupted upload or only unseen chunks.
+        meta = decode_file_meta(payload)
+        if not is_valid_filename(filename):
+            return self.reject_upload(connection, filename)
+        offered = offered_codecs(meta)
+        upload = self.storage.begin_upload(filename, meta)
+
+        # A client re-uploading a file the server already has may be asked
+        # for a delta against the stored copy instead of the ranges
+        basis, signature = self.open_delta_basis(filename, meta, upload)
+        codec = choose_codec(filename, offered) if basis is None else 'none'
+        connection.put(encode_file_status(filename=filename, ranges=upload.ranges, codec=codec, delta=signature))
+
+        started = time.perf_counter()
+        received = 0
+        try:
+            if basis is not None:
+                entry = BatchEntry(self.storage, meta, upload)
+                received = recv_delta(client_socket, entry, basis, signature)
+                if entry.position != entry.size:
+                    raise ProtocolError("The delta does not rebuild a file of the announced size.")
+
+            for offset, length in upload.ranges if basis is None else []:
+                upload.start_range(offset, length)
+                if codec != 'none':
+                    received += recv_compressed_data(client_socket, upload, codec, length)
+                elif recv_file_data(client_socket, upload) != length:
+                    raise ProtocolError("File data does not match the requested range.")
+                else:
+                    received += length
+                upload.end_range()
+        finally:
+            upload.close()
+            if basis is not None:
+                basis.close()
+
+        self.metrics.record_transfer('in', received, started)
+
+        error = upload.finish() if basis is None else entry.finish()
+        self.file_uploaded(filename, error is None)
+
+        # Every upload ends with a FILE_STATUS saying whether it was stored
+        connection.put(encode_file_status(filename=filename, stored=error is None, error=error))
+        if error:
+            self.metrics.record_error('upload_rejected')
+            return False
+        return True
+
+    # Turns down an upload whose name is not a plain filename, such as a path.
+    # The client gets no ranges to send, then the FILE_STATUS that ends the
+    # upload.
+    #
+    # Returns:
+    #     bool: False, for the caller to return.
+    def reject_upload(self, connection, filename):
+        error = f"Error: Invalid filename {filename!r}; the file was not stored."
+        connection.put(encode_file_status(filename=filename, ranges=[], error=error))
+        connection.put(encode_file_status(filename=filename, stored=False, error=error))
+        self.metrics.record_error('upload_rejected')
+        return False
+
+    # Handles /mstore: stores each entry of the stream as it arrives, then
+    # answers with a single FILE_STATUS for the whole batch.
+    #
+    # Returns:
+    #     bool: True if every file was stored.
+    def receive_batch(self, connection):
+        client_socket = connection.sock
+        started = time.perf_counter()
+        stored = []
+        errors = []
+        received = 0
+
+        while True:
+            meta = self.read_batch_entry(recv_frame(client_socket))
+            if meta is None:
                 break
 
-    def receive_file(self, client_socket, filename):
-        file_data = client_socket.recv(1024)
+            entry = BatchEntry(self.storage, meta)
+            try:
+                if meta['codec'] != 'none':
+                    received += recv_compressed_data(client_socket, entry, meta['codec'], entry.size)
+                elif recv_file_data(client_socket, entry) != entry.size:
+                    raise ProtocolError("File data does not match the announced size.")
+                else:
+                    received += entry.size
+            finally:
+                entry.close()
 
-        # Create a folder named 'received_files' if it doesn't exist
-        if not os.path.exists(self.folder_path):
-            os.makedirs(self.folder_path)
+            self.finish_batch_entry(entry, entry.finish(), stored, errors)
 
-        file_path = os.path.join(self.folder_path, filename)
-        
-        with open(file_path, 'wb') as file:
-            while True:
-                file_data = client_socket.recv(1024)
+        self.metrics.record_transfer('in', received, started)
+        connection.put(encode_file_status(batch='/mstore', files=len(stored), bytes=sum(stored), errors=errors))
+        return not errors
 
-                # Check for end-of-file marker
-                if b'<<EOF>>' in file_data:
-                    file.write(file_data[:-len(b'<<EOF>>')])
-                    break
+    # Opens the stored copy of a file to rebuild an upload from, if the client
+    # offers a delta and both the copy and what is left to upload are big
+    # enough to be worth it. Never raises once the upload has begun, so the
+    # caller does not have to close it.
+    #
+    # Returns:
+    #     tuple: (download, signature), or (None, None) to receive the ranges
+    #     as usual.
+    def open_delta_basis(self, filename, meta, upload):
+        if not meta.get('delta') or sum(length for _, length in upload.ranges) < DELTA_MIN_SIZE:
+            return None, None
 
-                file.write(file_data)
-        
-        file.close()
+        try:
+            basis = self.storage.open_download(filename)
+        except OSError:
+            return None, None
+
+        try:
+            if basis.size >= DELTA_MIN_SIZE:
+                return basis, compute_signature(basis)
+        except (OSError, ProtocolError):
+            pass  # e.g. replaced while it was being read; take the upload whole
+        except BaseException:
+            basis.close()
+            raise
 
-    def get_directory_listing(self):
-        files = os.listdir(self.folder_path)
-        return 'Server Directory\n' + '\n'.join(files)
+        basis.close()
+        return None, None
 
-    def send_file(self, client_socket, filename):
-        file_path = os.path.join(self.folder_path, filename)
-        
+    # Drops any cached copy of a file once an upload of it is over, and tells
+    # the other workers about the new version if it was stored.
+    def file_uploaded(self, filename, stored):
+        if self.cache is not None:
+            self.cache.invalidate(filename)
+
+        entry = self.storage.index.get(filename)
+        if stored and entry is not None and self.cluster is not None:
+            self.cluster.send('file', filename=filename, **entry._asdict())
+
+    # Another worker stored a file. Called on the cluster link's thread.
+    def receive_file_update(self, filename, size, mtime, sha256):
+        self.storage.index.update(filename, size, mtime, sha256)
+        if self.cache is not None:
+            self.cache.invalidate(filename)
+
+    # Checks the FILE_META that starts the next /mstore entry.
+    #
+    # Args:
+    #     frame (tuple): The frame read after the previous entry.
+    #
+    # Returns:
+    #     dict: The entry's metadata, or None at the end of the stream.
+    def read_batch_entry(self, frame):
+        if frame is None:
+            raise ConnectionResetError("Connection closed in the middle of a batch.")
+
+        frame_type, payload = frame
+        if frame_type != FRAME_FILE_META:
+            raise ProtocolError("Expected the next file of the batch.")
+
+        meta = decode_file_meta(payload)
+        if not meta:
+            return None
+
+        meta.setdefault('codec', 'none')
+        if meta['codec'] not in CODECS:
+            raise ProtocolError(f"Unknown codec {meta['codec']!r}.")
+        return meta
+
+    def finish_batch_entry(self, entry, error, stored, errors):
+        self.file_uploaded(entry.filename, error is None)
+
+        if error:
+            self.metrics.record_error('upload_rejected')
+            errors.append(error)
+        else:
+            stored.append(entry.size)
+
+    # Builds one page of the directory listing from the file index.
+    #
+    # Args:
+    #     args (list): /dir options as key=value strings.
+    #
+    # Returns:
+    #     list: Messages to send in order, the first one a header and the rest
+    #     at most DIR_LINES_PER_MESSAGE lines each.
+    def get_directory_listing(self, args=()):
         try:
-            with open(file_path, 'rb') as file:
-                client_socket.send(f"File received from Server: {filename}".encode('utf-8'))
-                file_data = file.read(1024)
-                while file_data:
-                    client_socket.send(file_data)
-                    file_data = file.read(1024)
-                    
-                client_socket.send(b'<<EOF>>')
-            
-            file.close()
-            
+            options = dict(arg.split('=', 1) for arg in args)
+            page = int(options.pop('page', 1))
+            limit = int(options.pop('limit', DIR_PAGE_SIZE))
+            sort = options.pop('sort', 'name')
+            order = options.pop('order', 'asc')
+            prefix = options.pop('prefix', '')
+            pattern = options.pop('match', None)
+        except ValueError:
+            return [DIR_USAGE]
+
+        if options or page < 1 or not 1 <= limit <= DIR_MAX_PAGE_SIZE or sort not in SORT_KEYS or order not in ['asc', 'desc']:
+            return [DIR_USAGE]
+
+        files = self.storage.index.query(prefix, pattern, sort, order == 'desc')
+        pages = max(1, (len(files) + limit - 1) // limit)
+
+        lines = []
+        for name, entry in files[(page - 1) * limit:page * limit]:
+            modified = datetime.fromtimestamp(entry.mtime).strftime('%Y-%m-%d %H:%M:%S')
+            lines.append(f"{name}  {entry.size} bytes  {modified}")
+
+        # The header says how many lines follow, so clients can tell where
+        # the listing ends
+        listing = [f"Server Directory (page {page} of {pages}, {len(files)} files, {len(lines)} on this page)"]
+
+        for start in range(0, len(lines), DIR_LINES_PER_MESSAGE):
+            listing.append('\n'.join(lines[start:start + DIR_LINES_PER_MESSAGE]))
+
+        return listing
+
+    # Opens a file for /get and works out which bytes to send and how.
+    #
+    # Args:
+    #     filename (str): The requested file.
+    #     range_args (list): Optional [offset] or [offset, length] strings,
+    #         plus optional codecs=<codec>,... and resume=<offset> options
+    #         anywhere after them. resume= is what a client sends to continue
+    #         a partial download: unlike an offset, one past the end of the
+    #         file, which its partial copy of an older version can be, gets
+    #         the whole file.
+    #
+    # Returns:
+    #     tuple: (download, meta) where meta is the FILE_META to send.
+    #
+    # Raises:
+    #     FileNotFoundError: If the file does not exist or the name is not a
+    #         plain filename.
+    #     ValueError: If the byte range is malformed or out of bounds.
+    def open_download(self, filename, range_args):
+        if not is_valid_filename(filename):
+            raise FileNotFoundError(filename)
+
+        download = self.open_cached_download(filename) or self.storage.open_download(filename)
+
+        try:
+            codecs = []
+            resume = None
+            for arg in range_args:
+                if arg.startswith('codecs='):
+                    codecs = parse_codecs(arg[len('codecs='):])
+                elif arg.startswith('resume='):
+                    resume = int(arg[len('resume='):])
+            range_args = [arg for arg in range_args if not arg.startswith(('codecs=', 'resume='))]
+
+            size = download.size
+            if resume is not None and not range_args:
+                range_args = [str(resume if resume <= size else 0)]
+            offset = int(range_args[0]) if range_args else 0
+            length = int(range_args[1]) if len(range_args) > 1 else size - offset
+
+            if offset < 0 or length < 0 or offset > size:
+                raise ValueError(f"Invalid byte range for {filename}")
+
+            length = min(length, size - offset)
+
+            codec = choose_codec(filename, codecs)
+            if codec != 'none' and not is_compressible(read_sample(download.segments(offset, length))):
+                codec = 'none'
+
+            meta = {'filename': filename, 'size': size, 'offset': offset, 'length': length,
+                    'sha256': download.sha256, 'codec': codec}
+        except Exception:
+            download.close()
+            raise
+
+        return download, meta
+
+    # Serves a file from the cache, loading it there first if it is small
+    # enough and the index already knows its hash.
+    #
+    # Returns:
+    #     CachedDownload: Or None if the file has to come from storage.
+    def open_cached_download(self, filename):
+        if self.cache is None:
+            return None
+
+        entry = self.storage.index.get(filename)
+        if entry is None or entry.sha256 is None or entry.size > self.cache.max_file_size:
+            return None
+
+        data = self.cache.get_or_load(filename, entry, functools.partial(self.read_file, filename, entry.size))
+        return CachedDownload(data, entry.sha256) if data is not None else None
+
+    # Reads a whole file from storage.
+    #
+    # Returns:
+    #     bytes: The contents, or None if the file is not the expected size.
+    def read_file(self, filename, size):
+        download = self.storage.open_download(filename)
+        try:
+            if download.size != size:
+                return None
+
+            parts = []
+            for file, offset, length in download.segments(0, size):
+                file.seek(offset)
+                parts.append(file.read(length))
+        finally:
+            download.close()
+
+        data = b''.join(parts)
+        return data if len(data) == size else None
+
+    # Transfer job for /get under the threaded engine. It runs on the
+    # connection's writer thread, so it writes to the socket directly.
+    def send_file(self, client_socket, filename, range_args=()):
+        started = time.perf_counter()
+        try:
+            download, meta = self.open_download(filename, range_args)
+
         except FileNotFoundError:
-            client_socket.send('Error: File not found in the server.'.encode('utf-8'))
+            self.metrics.record_error('not_found')
+            self.metrics.record_command('/get', started, error=True)
+            send_message(client_socket, 'Error: File not found in the server.')
+            return
+
+        except ValueError:
+            self.metrics.record_error('bad_range')
+            self.metrics.record_command('/get', started, error=True)
+            send_message(client_socket, 'Error: Invalid byte range. Use /get <filename> [<offset> [<length>]] [codecs=<codec>,...].')
+            return
+
+        except OSError:
+            # e.g. a directory or a file the server may not read
+            self.metrics.record_error('unreadable')
+            self.metrics.record_command('/get', started, error=True)
+            send_message(client_socket, 'Error: The file could not be read on the server.')
+            return
+
+        try:
+            sent = self.send_download(client_socket, download, meta)
+
+        except (OSError, ProtocolError):
+            self.metrics.record_command('/get', started, error=True)
+            raise
+
+        finally:
+            download.close()
+
+        self.metrics.record_transfer('out', sent, started)
+        self.metrics.record_command('/get', started)
+
+    # Sends the FILE_META and data of an opened download.
+    #
+    # Returns:
+    #     int: Bytes of file data put on the wire.
+    def send_download(self, client_socket, download, meta):
+        segments = download.segments(meta['offset'], meta['length'])
+
+        if meta['codec'] != 'none':
+            client_socket.sendall(encode_file_meta(**meta))
+            sent = 0
+            for frame in compress_frames(segments, meta['codec']):
+                client_socket.sendall(frame)
+                sent += len(frame)
+            return sent
+
+        # The metadata and data header go out together, which matters when
+        # /mget sends thousands of small files
+        client_socket.sendall(encode_file_meta(**meta) + encode_file_data_header(meta['length']))
+        if isinstance(download, CachedDownload):
+            client_socket.sendall(download.view(meta['offset'], meta['length']))
+        else:
+            for file, offset, length in segments:
+                sendfile_exact(client_socket, file, offset, length)
+        return meta['length']
+
+    # Finds the files an /mget asks for.
+    #
+    # Args:
+    #     patterns (list): Globs matched against stored names.
+    #
+    # Returns:
+    #     tuple: (names in order without duplicates, patterns that matched nothing)
+    def match_files(self, patterns):
+        names = {}
+        missing = []
+        for pattern in patterns:
+            matches = self.storage.index.query(pattern=pattern)
+            if not matches:
+                missing.append(pattern)
+            for name, _ in matches:
+                names.setdefault(name)
+        return list(names), missing
+
+    # Transfer job for /mget under the threaded engine: sends every matching
+    # file as a batch entry, then a FILE_STATUS that ends the batch.
+    def send_batch(self, client_socket, patterns):
+        started = time.perf_counter()
+        codec_args = [arg for arg in patterns if arg.startswith('codecs=')]
+        names, missing = self.match_files([arg for arg in patterns if not arg.startswith('codecs=')])
+        files = size = sent = 0
+
+        try:
+            for name in names:
+                try:
+                    download, meta = self.open_download(name, codec_args)
+                except OSError:
+                    missing.append(name)  # removed or unreadable since the index was read
+                    continue
+
+                try:
+                    sent += self.send_download(client_socket, download, dict(meta, batch=True))
+                finally:
+                    download.close()
+                files += 1
+                size += meta['length']
+
+        except (OSError, ProtocolError):
+            self.metrics.record_command('/mget', started, error=True)
+            raise
+
+        send_file_status(client_socket, batch='/mget', files=files, bytes=size, missing=missing)
+        self.metrics.record_transfer('out', sent, started)
+        self.metrics.record_command('/mget', started, error=bool(missing))
 
     def print_help(self, client_socket):
         help_info = """
         Disconnect to the server application: /leave
         Register a unique handle or alias: /register <handle>
         Send file to server: /store <filename>
-        Request directory file list from a server: /dir
-        Fetch a file from a server: /get <filename>
+        Request directory file list from a server: /dir [prefix=<text>] [match=<glob>] [sort=name|size|mtime] [order=asc|desc] [page=<n>] [limit=<n>]
+        Fetch a file from a server: /get <filename> [<offset> [<length>]] [codecs=zlib,lzma]
+        Send many files to server: /mstore <path or glob>...
+        Fetch every file matching a glob: /mget <glob>... [codecs=zlib,lzma]
+        Show server statistics: /stats [json]
         Request command help to output all Input: /?
         """
-        client_socket.send(help_info.encode('utf-8'))
+        self.deliver_message(client_socket, help_info)
 
-    def broadcast_message(self, message):
-        for handle, socket in self.client_sockets.items():
-            try:
-                socket.send(message.encode('utf-8'))
-            except Exception as e:
-                # Handle the exception (e.g., remove the client)
-                print(e)
+    # Fan-out only queues the message on each recipient's connection; their
+    # writers deliver it, so a stalled client cannot hold up the sender.
+    # The sender's own copy is the reply to its /broadcast, so it is a MESSAGE
+    # and never dropped.
+    def broadcast_message(self, message, sender=None):
+        payload = message.encode('utf-8')
+        chat = encode_frame(FRAME_CHAT, payload)
+        connections = self.registry.connections()
+        dropped = 0
+        for connection in connections:
+            if connection is sender:
+                connection.put(encode_frame(FRAME_MESSAGE, payload))
+            elif not connection.put(chat, droppable=True):
+                dropped += 1
+        self.metrics.record_chat('/broadcast', len(connections), dropped)
+        self.registry.forward_broadcast(message)
 
+    # Returns:
+    #     bool: False if no client is registered under recipient_handle.
     def unicast_message(self, recipient_handle, message):
-        if recipient_handle in self.client_sockets:
-            try:
-                self.client_sockets[recipient_handle].send(message.encode('utf-8'))
-            except Exception as e:
-                # Handle the exception (e.g., remove the client)
-                print(e)
+        connection = self.registry.get(recipient_handle)
+        if connection is None:
+            return self.registry.forward_message(recipient_handle, message)
+
+        delivered = self.deliver_chat(connection, message)
+        self.metrics.record_chat('/message', 1, 0 if delivered else 1)
+        return True
+
+    # Chat another worker relayed for this one's clients; handle is None for a
+    # broadcast. Called on the cluster link's thread, so under asyncio the
+    # connections are handed the message from the event loop instead.
+    def receive_forwarded(self, handle, message):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.deliver_forwarded, handle, message)
+        else:
+            self.deliver_forwarded(handle, message)
+
+    def deliver_forwarded(self, handle, message):
+        frame = encode_frame(FRAME_CHAT, message.encode('utf-8'))
+        if handle is None:
+            connections = self.registry.connections()
+        else:
+            connections = [connection for connection in [self.registry.get(handle)] if connection is not None]
+
+        dropped = sum(not connection.put(frame, droppable=True) for connection in connections)
+        self.metrics.record_chat('/broadcast' if handle is None else '/message', len(connections), dropped)
         
+    # Runs the asyncio engine: every connection is a coroutine on a single
+    # event loop, and blocking file system work goes to a bounded thread pool.
+    async def serve_async(self):
+        self.file_executor = ThreadPoolExecutor(max_workers=self.file_workers, thread_name_prefix='file-io')
+        self.loop = asyncio.get_running_loop()
+        self.server_socket.setblocking(False)
+
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server_socket)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.file_executor.shutdown(wait=False)
+
+    async def run_file_io(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.file_executor, function, *args)
+
+    # handle_chat_command for the asyncio engine. In multi-process mode
+    # /register and /message for a handle on another worker wait for the
+    # coordinator, so that round trip is made on the file I/O pool instead of
+    # holding up the event loop. The registry may be used from any thread.
+    async def handle_chat_command_async(self, connection, command, args):
+        handle = self.get_handle(connection)
+
+        if self.cluster is not None and command == '/register' and handle is None:
+            if await self.run_file_io(self.registry.register, args[0], connection):
+                self.deliver_message(connection, f"Welcome {args[0]}!")
+            else:
+                self.deliver_message(connection, "Error: Handle or alias already exists.")
+
+        elif self.cluster is not None and command == '/message' and handle is not None and args and args[0] not in self.registry:
+            recipient_handle = args[0]
+            message = ' '.join(args[1:])
+            if await self.run_file_io(self.registry.forward_message, recipient_handle, f"Message from {handle}: {message}"):
+                self.deliver_message(connection, f"Message to {recipient_handle}: {message}")
+            else:
+                self.deliver_message(connection, f"Error: No client is registered as {recipient_handle}.")
+
+        else:
+            self.handle_chat_command(connection, command, args)
+
+    async def handle_client_async(self, reader, writer):
+        if not self.admit_connection():
+            writer.write(encode_frame(FRAME_MESSAGE, b'Error: The server is full. Try again later.'))
+            try:
+                await asyncio.wait_for(writer.drain(), REJECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                pass
+            writer.transport.abort()
+            return
+
+        print(f"Accepted connection from {writer.get_extra_info('peername')}")
+        connection = AsyncClientConnection(writer, self.slow_client_policy, buckets=self.connection_buckets())
+        self.metrics.connection_opened()
+
+        try:
+            while True:
+                try:
+                    await connection.wait_for_room()
+
+                    frame = await self.read_command_async(reader, connection)
+                    if frame is None:
+                        break
+
+                    frame_type, payload = frame
+                    if frame_type != FRAME_COMMAND:
+                        self.deliver_message(connection, "Error: Expected a command.")
+                        continue
+
+                    data = payload.decode('utf-8')
+                    if not data.strip():
+                        continue
+
+                    if self.is_command(connection, data) == False:
+                        break
+
+                    command, *args = data.split()
+                    started = time.perf_counter()
+                    failed = False
+
+                    if command == '/leave':
+                        self.deliver_message(connection, "Connection closed. Thank you!")
+                        break
+
+                    elif command == '/store':
+                        failed = not await self.receive_file_async(reader, connection, args[0])
+
+                    elif command == '/mstore':
+                        failed = not await self.receive_batch_async(reader, connection)
+
+                    elif command == '/dir':
+                        for file_list in await self.run_file_io(self.get_directory_listing, args):
+                            self.deliver_message(connection, file_list)
+
+                    elif command == '/get':
+                        connection.put(functools.partial(self.send_file_async, filename=args[0], range_args=args[1:]))
+                        continue  # the transfer job records its own latency
+
+                    elif command == '/mget':
+                        connection.put(functools.partial(self.send_batch_async, patterns=args))
+                        continue
+
+                    else:
+                        await self.handle_chat_command_async(connection, command, args)
+
+                    self.metrics.record_command(command, started, failed)
+
+                except asyncio.TimeoutError:
+                    self.metrics.record_error('idle_timeout')
+                    self.deliver_message(connection, f"Disconnected after {self.idle_timeout:g} seconds of inactivity.")
+                    break
+
+                except OSError:
+                    self.metrics.record_error('connection')
+                    break
+
+                except (ProtocolError, UnicodeDecodeError):
+                    self.metrics.record_error('protocol')
+                    break
+
+        finally:
+            self.remove_client(connection)
+            await connection.flush_and_close()
+            self.metrics.connection_closed()
+            self.release_connection()
+
+    # read_frame with the idle timeout: waiting for the next frame only times
+    # out while nothing is being sent to the client, and a frame that stalls
+    # halfway always does.
+    #
+    # Raises:
+    #     asyncio.TimeoutError: If the client was idle for idle_timeout seconds.
+    async def read_command_async(self, reader, connection):
+        if self.idle_timeout is None:
+            return await read_frame(reader)
+
+        while True:
+            try:
+                # Nothing is consumed from the reader until the whole header
+                # has arrived, so waiting can be cancelled safely
+                header = await asyncio.wait_for(read_header(reader), self.idle_timeout)
+                break
+            except asyncio.TimeoutError:
+                if connection.is_idle():
+                    raise
+
+        if header is None:
+            return None
+
+        frame_type, length = header
+        if frame_type == FRAME_FILE_DATA:
+            raise ProtocolError("Unexpected file data frame.")
+
+        return frame_type, await asyncio.wait_for(read_exact(reader, length), self.idle_timeout)
+
+    # Reads part of an upload under the asyncio engine. A client that stalls
+    # in the middle of an upload is held to the idle timeout too.
+    async def read_timed(self, read, reader, *args):
+        if self.idle_timeout is None:
+            return await read(reader, *args)
+        return await asyncio.wait_for(read(reader, *args), self.idle_timeout)
+
+    async def receive_file_async(self, reader, connection, filename):
+        frame = await self.read_timed(read_frame, reader)
+        if frame is None:
+            raise ConnectionResetError("Connection closed before the file was sent.")
+
+        frame_type, payload = frame
+        if frame_type != FRAME_FILE_META:
+            self.deliver_message(connection, "Error: Expected file metadata.")
+            return False
+
+        meta = decode_file_meta(payload)
+        if not is_valid_filename(filename):
+            return self.reject_upload(connection, filename)
+        offered = offered_codecs(meta)
+        upload = await self.run_file_io(self.storage.begin_upload, filename, meta)
+        basis, signature = await self.run_file_io(self.open_delta_basis, filename, meta, upload)
+        codec = choose_codec(filename, offered) if basis is None else 'none'
+        connection.put(encode_file_status(filename=filename, ranges=upload.ranges, codec=codec, delta=signature))
+
+        started = time.perf_counter()
+        received = 0
+        try:
+            if basis is not None:
+                entry = BatchEntry(self.storage, meta, upload)
+                received = await self.receive_delta_async(reader, entry, basis, signature)
+                if entry.position != entry.size:
+                    raise ProtocolError("The delta does not rebuild a file of the announced size.")
+
+            for offset, length in upload.ranges if basis is None else []:
+                if codec != 'none':
+                    await self.run_file_io(upload.start_range, offset, length)
+                    received += await self.receive_compressed_async(reader, DecompressingWriter(upload, codec, length))
+                    await self.run_file_io(upload.end_range)
+                    continue
+
+                header = await self.read_timed(read_header, reader)
+                if header is None or header[0] != FRAME_FILE_DATA or header[1] != length:
+                    raise ProtocolError("File data does not match the requested range.")
+
+                await self.run_file_io(upload.start_range, offset, length)
+                remaining = length
+                while remaining > 0:
+                    chunk = await self.read_timed(read_exact, reader, min(BUFFER_SIZE, remaining))
+                    await self.run_file_io(upload.write, chunk)
+                    remaining -= len(chunk)
+                received += length
+                await self.run_file_io(upload.end_range)
+        finally:
+            await self.run_file_io(upload.close)
+            if basis is not None:
+                await self.run_file_io(basis.close)
+
+        self.metrics.record_transfer('in', received, started)
+
+        error = await self.run_file_io(upload.finish if basis is None else entry.finish)
+        self.file_uploaded(filename, error is None)
+
+        # Every upload ends with a FILE_STATUS saying whether it was stored
+        connection.put(encode_file_status(filename=filename, stored=error is None, error=error))
+        if error:
+            self.metrics.record_error('upload_rejected')
+            return False
+        return True
+
+    # receive_batch for the asyncio engine. An uncompressed entry that fits in
+    # one buffer is stored with a single trip to the file I/O pool.
+    async def receive_batch_async(self, reader, connection):
+        started = time.perf_counter()
+        stored = []
+        errors = []
+        received = 0
+
+        while True:
+            meta = self.read_batch_entry(await self.read_timed(read_frame, reader))
+            if meta is None:
+                break
+
+            if meta['codec'] == 'none':
+                header = await self.read_timed(read_header, reader)
+                if header is None or header[0] != FRAME_FILE_DATA or header[1] != meta.get('size'):
+                    raise ProtocolError("File data does not match the announced size.")
+
+            if meta['codec'] == 'none' and meta['size'] <= BUFFER_SIZE:
+                data = await self.read_timed(read_exact, reader, meta['size'])
+                entry, error = await self.run_file_io(self.store_batch_entry, meta, data)
+                received += meta['size']
+                self.finish_batch_entry(entry, error, stored, errors)
+                continue
+
+            entry = await self.run_file_io(BatchEntry, self.storage, meta)
+            try:
+                if meta['codec'] != 'none':
+                    received += await self.receive_compressed_async(reader, DecompressingWriter(entry, meta['codec'],
+                                                                                                entry.size))
+                else:
+                    remaining = entry.size
+                    while remaining > 0:
+                        chunk = await self.read_timed(read_exact, reader, min(BUFFER_SIZE, remaining))
+                        await self.run_file_io(entry.write, chunk)
+                        remaining -= len(chunk)
+                    received += entry.size
+            finally:
+                await self.run_file_io(entry.close)
+
+            self.finish_batch_entry(entry, await self.run_file_io(entry.finish), stored, errors)
+
+        self.metrics.record_transfer('in', received, started)
+        connection.put(encode_file_status(batch='/mstore', files=len(stored), bytes=sum(stored), errors=errors))
+        return not errors
+
+    # Stores a small /mstore entry whose data has already been read.
+    #
+    # Returns:
+    #     tuple: (BatchEntry, error message or None)
+    def store_batch_entry(self, meta, data):
+        entry = BatchEntry(self.storage, meta)
+        try:
+            entry.write(data)
+        finally:
+            entry.close()
+        return entry, entry.finish()
+
+    # recv_delta for the asyncio engine, with the copying and writing done in
+    # the file I/O pool.
+    async def receive_delta_async(self, reader, entry, basis, signature):
+        received = 0
+
+        while True:
+            header = await self.read_timed(read_header, reader)
+            if header is None:
+                raise ConnectionResetError("Connection closed in the middle of a delta.")
+
+            frame_type, length = header
+            received += HEADER.size + length
+
+            if frame_type == FRAME_FILE_META:
+                op = decode_file_meta(await self.read_timed(read_exact, reader, length))
+                if not op:
+                    return received
+                await self.run_file_io(copy_range, basis, entry, *parse_copy(op, signature))
+
+            elif frame_type == FRAME_FILE_DATA:
+                while length > 0:
+                    chunk = await self.read_timed(read_exact, reader, min(BUFFER_SIZE, length))
+                    await self.run_file_io(entry.write, chunk)
+                    length -= len(chunk)
+
+            else:
+                raise ProtocolError(f"Expected delta data, got frame type {frame_type}.")
+
+    # Reads compressed FILE_DATA frames up to the empty one that ends a range,
+    # decompressing them in the file I/O pool.
+    #
+    # Returns:
+    #     int: Bytes received on the wire, including frame headers.
+    async def receive_compressed_async(self, reader, decompressing_writer):
+        received = 0
+        while True:
+            header = await self.read_timed(read_header, reader)
+            if header is None or header[0] != FRAME_FILE_DATA or header[1] > BUFFER_SIZE:
+                raise ProtocolError("Expected a compressed block of file data.")
+            received += HEADER.size + header[1]
+
+            if header[1] == 0:
+                await self.run_file_io(decompressing_writer.finish)
+                return received
+
+            block = await self.read_timed(read_exact, reader, header[1])
+            await self.run_file_io(decompressing_writer.write, block)
+
+    # Transfer job for /get under the asyncio engine. It runs in the
+    # connection's writer task, so it writes to the StreamWriter directly.
+    async def send_file_async(self, writer, filename, range_args=()):
+        started = time.perf_counter()
+        try:
+            download, meta = await self.run_file_io(self.open_download, filename, range_args)
+
+        except FileNotFoundError:
+            self.metrics.record_error('not_found')
+            self.metrics.record_command('/get', started, error=True)
+            writer.write(encode_frame(FRAME_MESSAGE, b'Error: File not found in the server.'))
+            return
+
+        except ValueError:
+            self.metrics.record_error('bad_range')
+            self.metrics.record_command('/get', started, error=True)
+            writer.write(encode_frame(FRAME_MESSAGE,
+                                      b'Error: Invalid byte range. Use /get <filename> [<offset> [<length>]] [codecs=<codec>,...].'))
+            return
+
+        except OSError:
+            self.metrics.record_error('unreadable')
+            self.metrics.record_command('/get', started, error=True)
+            writer.write(encode_frame(FRAME_MESSAGE, b'Error: The file could not be read on the server.'))
+            return
+
+        try:
+            sent = await self.send_download_async(writer, download, meta)
+
+        except (OSError, ProtocolError):
+            self.metrics.record_command('/get', started, error=True)
+            raise
+
+        finally:
+            await self.run_file_io(download.close)
+
+        self.metrics.record_transfer('out', sent, started)
+        self.metrics.record_command('/get', started)
+
+    # send_download for the asyncio engine.
+    async def send_download_async(self, writer, download, meta):
+        writer.write(encode_file_meta(**meta))
+
+        if meta['codec'] != 'none':
+            # Compression is CPU work, so the pool produces the frames
+            sent = 0
+            frames = compress_frames(download.segments(meta['offset'], meta['length']), meta['codec'])
+            while True:
+                frame = await self.run_file_io(next, frames, None)
+                if frame is None:
+                    break
+                writer.write(frame)
+                sent += len(frame)
+                await writer.drain()
+            return sent
+
+        writer.write(encode_file_data_header(meta['length']))
+        if isinstance(download, CachedDownload):
+            # Written a QUANTUM at a time when a rate limit has to pace it
+            view = download.view(meta['offset'], meta['length'])
+            step = QUANTUM if writer.buckets else max(len(view), 1)
+            for start in range(0, len(view), step):
+                writer.write(view[start:start + step])
+                await writer.drain()
+            await writer.drain()
+            return meta['length']
+
+        await writer.drain()
+
+        # loop.sendfile uses os.sendfile on the transport's socket when it can
+        # and falls back to reading the file in chunks otherwise.
+        segments = download.segments(meta['offset'], meta['length'])
+        while True:
+            segment = await self.run_file_io(next, segments, None)
+            if segment is None:
+                break
+
+            file, offset, length = segment
+            if length > 0:
+                count = await writer.sendfile(file, offset, length)
+                if count != length:
+                    raise ProtocolError("File shrank while it was being sent.")
+        return meta['length']
+
+    # Transfer job for /mget under the asyncio engine.
+    async def send_batch_async(self, writer, patterns):
+        started = time.perf_counter()
+        codec_args = [arg for arg in patterns if arg.startswith('codecs=')]
+        names, missing = await self.run_file_io(self.match_files,
+                                                [arg for arg in patterns if not arg.startswith('codecs=')])
+        files = size = sent = 0
+
+        try:
+            for name in names:
+                try:
+                    download, meta = await self.run_file_io(self.open_download, name, codec_args)
+                except OSError:
+                    missing.append(name)
+                    continue
+
+                try:
+                    sent += await self.send_download_async(writer, download, dict(meta, batch=True))
+                finally:
+                    await self.run_file_io(download.close)
+                files += 1
+                size += meta['length']
+
+        except (OSError, ProtocolError):
+            self.metrics.record_command('/mget', started, error=True)
+            raise
+
+        writer.write(encode_file_status(batch='/mget', files=files, bytes=size, missing=missing))
+        self.metrics.record_transfer('out', sent, started)
+        self.metrics.record_command('/mget', started, error=bool(missing))
+
 if __name__ == "__main__":
-    server = FileExchangeServer('localhost', 12345)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="File Exchange Server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--engine', choices=ENGINES, default='threaded',
+                        help="threaded: one thread per connection; asyncio: a single event loop")
+    parser.add_argument('--file-workers', type=int, default=4,
+                        help="Size of the file I/O thread pool used by the asyncio engine")
+    parser.add_argument('--storage', choices=STORAGES, default='plain',
+                        help="plain: one file per name; dedup: content-addressed, deduplicated chunks")
+    parser.add_argument('--rescan-interval', type=float, default=60,
+                        help="Seconds between rescans of the storage folder for the file index (0 disables)")
+    parser.add_argument('--slow-client-policy', choices=SLOW_CLIENT_POLICIES, default='drop',
+                        help="What to do with chat for a client whose outbound queue is full")
+    parser.add_argument('--no-metrics', action='store_true', help="Disable instrumentation and /stats")
+    parser.add_argument('--metrics-host', default='localhost', help="Address of the metrics HTTP endpoint")
+    parser.add_argument('--metrics-port', type=int,
+                        help="Serve /metrics (Prometheus text) and /metrics.json over HTTP on this port")
+    parser.add_argument('--cache-mb', type=float, default=0,
+                        help="Memory for caching recently fetched files, in MB (0 disables the cache)")
+    parser.add_argument('--cache-max-file-mb', type=float,
+                        help="Largest file to cache, in MB (default: a quarter of --cache-mb)")
+    parser.add_argument('--rate-limit-mb', type=float, default=0,
+                        help="Bandwidth shared by all transfers to clients, in MB/s (0: unlimited)")
+    parser.add_argument('--client-rate-limit-mb', type=float, default=0,
+                        help="Bandwidth for transfers to any one client, in MB/s (0: unlimited)")
+    parser.add_argument('--max-connections', type=int, default=0,
+                        help="Connections served at once; more are turned away (0: unlimited)")
+    parser.add_argument('--idle-timeout', type=float, default=0,
+                        help="Seconds a client may stay idle before it is disconnected (0: never)")
+    parser.add_argument('--durability', choices=DURABILITY_MODES, default='none',
+                        help="none: no fsync; fsync: flush every upload before confirming it; "
+                             "group: flush uploads that finish together in one round")
+    parser.add_argument('--disk-writers', type=int, default=4,
+                        help="Threads writing uploads to disk behind the network (0: write on the receiving thread)")
+    parser.add_argument('--write-buffer-mb', type=float, default=WRITE_BUFFER_SIZE / (1024 * 1024),
+                        help="Data of one upload that may be waiting for the disk writers, in MB")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Server processes sharing the port; more than one needs SO_REUSEPORT and Unix sockets")
+    args = parser.parse_args()
+
+    if args.workers > 1 and not (hasattr(socket, 'SO_REUSEPORT') and hasattr(socket, 'AF_UNIX')):
+        parser.error("--workers needs SO_REUSEPORT and Unix sockets, which this platform does not have")
+
+    options = dict(host=args.host, port=args.port, engine=args.engine, file_workers=args.file_workers,
+                   storage=args.storage, rescan_interval=args.rescan_interval,
+                   slow_client_policy=args.slow_client_policy, metrics=not args.no_metrics,
+                   metrics_host=args.metrics_host, metrics_port=args.metrics_port,
+                   cache_size=int(args.cache_mb * 1024 * 1024),
+                   cache_max_file_size=int(args.cache_max_file_mb * 1024 * 1024) if args.cache_max_file_mb else None,
+                   rate_limit=int(args.rate_limit_mb * 1024 * 1024),
+                   client_rate_limit=int(args.client_rate_limit_mb * 1024 * 1024),
+                   max_connections=args.max_connections, idle_timeout=args.idle_timeout,
+                   durability=args.durability, disk_writers=args.disk_writers,
+                   write_buffer_size=int(args.write_buffer_mb * 1024 * 1024))
+
+    if args.workers > 1:
+        run_workers(args.workers, FileExchangeServer, **options)
+    else:
+        server = FileExchangeServer(**options)
\ No newline at end of file
@@ -0,0 +1,191 @@
+import asyncio
+import threading
+import time
+
+# Bandwidth shaping for what the server sends.
+#
+# Transfers are paced with token buckets. A bucket fills at `rate` bytes per
+# second up to a burst of BURST_SECONDS worth of traffic, and a transfer takes
+# tokens for every QUANTUM bytes it sends. Each connection can have a bucket of
+# its own, and all connections share the server-wide one. A sender that finds
+# a bucket short books the tokens anyway, putting the bucket into debt, and
+# sleeps until they would have been there.
+#
+# Bookings are served in the order they are made, and a transfer books its next
+# QUANTUM only once it has sent the last one, so concurrent transfers take
+# turns a QUANTUM at a time whatever their sizes. A small file waits for one
+# turn of each running transfer rather than for them to finish.
+#
+# Only transfer jobs are shaped. Replies and chat bypass the buckets, so they
+# stay fast while bulk transfers run.
+#
+# Transfers with no buckets still send in turns, so that the connection can
+# tell a slow client from a stalled one. Their turns start at QUANTUM and
+# double up to MAX_TURN while each one goes out within FAST_TURN_SECONDS, so a
+# fast client is not held back by small sends.
+
+# Bytes a transfer sends per turn.
+QUANTUM = 64 * 1024
+
+# Largest turn of an unshaped transfer, and how quickly a turn has to go out
+# for the next one to be bigger.
+MAX_TURN = 4 * 1024 * 1024
+FAST_TURN_SECONDS = 0.1
+
+# Seconds of traffic an idle bucket saves up.
+BURST_SECONDS = 0.25
+
+
+# Attributes:
+#     rate (float): Bytes per second.
+#     burst (float): Most tokens the bucket holds.
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError(f"Invalid rate {rate!r}")
+
+        self.rate = rate
+        self.burst = burst if burst is not None else max(QUANTUM, rate * BURST_SECONDS)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Books tokens for count bytes.
+    #
+    # Returns:
+    #     float: Seconds to wait before sending them.
+    def reserve(self, count):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            return max(0.0, -self.tokens / self.rate)
+
+
+# Returns:
+#     int: The size of a transfer's next turn, after one of size bytes that
+#         took elapsed seconds.
+def next_turn(size, buckets, elapsed):
+    if buckets or elapsed > FAST_TURN_SECONDS:
+        return QUANTUM
+    return min(size * 2, MAX_TURN)
+
+
+# Books count bytes in every bucket.
+#
+# Returns:
+#     float: Seconds until all of them allow sending.
+def reserve(buckets, count):
+    return max(bucket.reserve(count) for bucket in buckets)
+
+
+# Socket for a transfer job under the threaded engine, sending in turns paced
+# by buckets. Turns are taken with no buckets too, so that progress, called
+# with the bytes of every turn, shows how the transfer is getting on. Anything
+# else is passed through to the socket.
+class ShapedSocket:
+    def __init__(self, sock, buckets=(), progress=None):
+        self.sock = sock
+        self.buckets = buckets
+        self.progress = progress
+
+    def wait(self, count):
+        if not self.buckets:
+            return
+
+        delay = reserve(self.buckets, count)
+        if delay > 0:
+            time.sleep(delay)
+
+    def sent(self, count):
+        if self.progress is not None:
+            self.progress(count)
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        start = 0
+        turn = QUANTUM
+        while start < len(view):
+            piece = view[start:start + turn]
+            self.wait(len(piece))
+            started = time.monotonic()
+            self.sock.sendall(piece)
+            self.sent(len(piece))
+            start += len(piece)
+            turn = next_turn(turn, self.buckets, time.monotonic() - started)
+
+    def sendfile(self, file, offset=0, count=None):
+        sent = 0
+        turn = QUANTUM
+        while count is None or sent < count:
+            size = turn if count is None else min(turn, count - sent)
+            self.wait(size)
+            started = time.monotonic()
+            piece = self.sock.sendfile(file, offset + sent, size)
+            self.sent(piece)
+            sent += piece
+            if piece < size:
+                break
+            turn = next_turn(turn, self.buckets, time.monotonic() - started)
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+# StreamWriter for a transfer job under the asyncio engine. Data written is
+# paid for, and reported to progress, on the next drain. The jobs always get
+# one, so that they can use sendfile.
+class ShapedWriter:
+    def __init__(self, writer, buckets=(), progress=None):
+        self.writer = writer
+        self.buckets = buckets
+        self.progress = progress
+        self.unpaid = 0
+
+    def write(self, data):
+        self.writer.write(data)
+        self.unpaid += len(data)
+
+    async def drain(self):
+        await self.writer.drain()
+        if self.unpaid:
+            await self.sent(self.unpaid)
+            self.unpaid = 0
+
+    async def sent(self, count):
+        if self.progress is not None:
+            self.progress(count)
+        if self.buckets:
+            delay = reserve(self.buckets, count)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    # Sends count bytes of a file with loop.sendfile, a turn at a time.
+    #
+    # Returns:
+    #     int: Bytes sent, fewer than count if the file ended first.
+    async def sendfile(self, file, offset, count):
+        loop = asyncio.get_running_loop()
+        await self.drain()
+        sent = 0
+        turn = QUANTUM
+        while sent < count:
+            size = min(turn, count - sent)
+            if self.buckets:
+                delay = reserve(self.buckets, size)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            started = time.monotonic()
+            piece = await loop.sendfile(self.writer.transport, file, offset + sent, size)
+            if self.progress is not None:
+                self.progress(piece)
+            sent += piece
+            if piece < size:
+                break
+            turn = next_turn(turn, self.buckets, time.monotonic() - started)
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
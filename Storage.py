@@ -0,0 +1,530 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from Index import FileIndex
+from Protocol import CHUNK_SIZE, ProtocolError, hash_file, is_sha256
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # claims on partial files then only hold within one process
+
+STORAGES = ['plain', 'dedup']
+
+# none: leave writing back to the operating system; a crash may lose files
+#     the client was told were stored.
+# fsync: flush every file and the directory entry naming it before replying.
+# group: like fsync, but uploads finishing at about the same time share one
+#     round of flushes run by a single thread.
+DURABILITY_MODES = ['none', 'fsync', 'group']
+
+# Seconds the group syncer waits for more uploads to join a round.
+GROUP_SYNC_DELAY = 0.005
+
+
+# Storage backends for FileExchangeServer.
+#
+# A backend hands out Upload objects for /store and Download objects for /get.
+# An Upload lists the byte ranges of the file it still needs from the client
+# (everything it cannot resume or deduplicate); the server then calls
+# start_range, write, end_range for each of them, and finish once they have
+# all arrived. A Download exposes the file's size and sha256 and yields the
+# (file, offset, length) segments to pass to sendfile for any byte range.
+#
+# Every backend keeps a FileIndex of what it stores in self.index. Uploads of
+# the same filename may run at once: each writes a file of its own, and the
+# step that makes one the stored version holds the filename's lock in
+# self.names, so the file on disk and the index always agree and the last
+# upload to finish wins.
+#
+# Args:
+#     kind (str): One of STORAGES.
+#     folder_path (str): Where the files are kept.
+#     durability (str): One of DURABILITY_MODES.
+#     pipeline: An UploadPipeline to write uploads behind the network, if any.
+def create_storage(kind, folder_path, durability='none', pipeline=None):
+    if kind == 'plain':
+        return FileStorage(folder_path, durability, pipeline)
+    if kind == 'dedup':
+        return ChunkStorage(folder_path, durability, pipeline)
+    raise ValueError(f"Unknown storage {kind!r}, expected one of {STORAGES}")
+
+
+def validate_meta(meta):
+    if not is_sha256(meta.get('sha256')) or not isinstance(meta.get('size'), int) or meta['size'] < 0:
+        raise ProtocolError("Invalid file metadata.")
+
+
+# Writes a small file so that readers see either the old or the new contents.
+def write_atomically(path, data, durability=None):
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        if durability is not None:
+            durability.sync(temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+# Flushes a file, or the entries of a directory, to disk. Windows cannot open
+# directories, so there only files are flushed.
+def fsync_path(path):
+    if os.path.isdir(path):
+        if os.name == 'nt':
+            return
+        fd = os.open(path, os.O_RDONLY)
+    else:
+        fd = os.open(path, os.O_RDWR)
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Carries out a backend's DURABILITY_MODES choice.
+class Durability:
+    def __init__(self, mode='none'):
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode {mode!r}, expected one of {DURABILITY_MODES}")
+
+        self.mode = mode
+        self.condition = threading.Condition()
+        self.pending = []  # (paths, waiter) for the next group round
+        if mode == 'group':
+            threading.Thread(target=self.run, name='group-sync', daemon=True).start()
+
+    # Returns once the paths are on disk, as far as the mode promises.
+    #
+    # Raises:
+    #     OSError: If flushing one of them failed.
+    def sync(self, *paths):
+        if self.mode == 'none' or not paths:
+            return
+
+        if self.mode == 'fsync':
+            for path in paths:
+                fsync_path(path)
+            return
+
+        waiter = [False, None]  # [done, error]
+        with self.condition:
+            self.pending.append((paths, waiter))
+            self.condition.notify_all()
+            while not waiter[0]:
+                self.condition.wait()
+
+        if waiter[1] is not None:
+            raise waiter[1]
+
+    # The group syncer: flushes every path asked for during a round once.
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+
+            time.sleep(GROUP_SYNC_DELAY)
+            with self.condition:
+                batch, self.pending = self.pending, []
+
+            errors = {}
+            for path in dict.fromkeys(path for paths, _ in batch for path in paths):
+                try:
+                    fsync_path(path)
+                except OSError as e:
+                    errors[path] = e
+
+            with self.condition:
+                for paths, waiter in batch:
+                    waiter[:] = [True, next((errors[path] for path in paths if path in errors), None)]
+                self.condition.notify_all()
+
+
+# A lock per name, created on first use and dropped once nobody holds or waits
+# for it.
+class NameLocks:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}  # name -> [threading.Lock, holders and waiters]
+
+    @contextmanager
+    def hold(self, name):
+        with self.lock:
+            entry = self.locks.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[name]
+
+
+# Stores every file as-is under folder_path/<filename>.
+#
+# Uploads go to folder_path/.partial/<sha256> first, so an interrupted upload
+# of the same content resumes from the end of the partial file, and are
+# renamed into place once their sha256 checks out. An upload holds a claim on
+# its partial file while it runs; another upload of the same content meanwhile
+# gets a private partial file, <sha256>.<suffix>, that cannot be resumed and is
+# removed at the next start if it is left behind.
+class FileStorage:
+    def __init__(self, folder_path, durability='none', pipeline=None):
+        self.folder_path = folder_path
+        self.partial_path = os.path.join(folder_path, '.partial')
+        self.durability = Durability(durability)
+        self.pipeline = pipeline
+        self.names = NameLocks()
+        self.claims_lock = threading.Lock()
+        self.claims = set()  # sha256 of the partial files uploads hold
+        self.index = FileIndex(self)
+
+        if os.path.exists(self.partial_path):
+            for name in os.listdir(self.partial_path):
+                if '.' in name:
+                    os.remove(os.path.join(self.partial_path, name))
+
+    def list_files(self):
+        if not os.path.exists(self.folder_path):
+            return []
+        return [entry.name for entry in os.scandir(self.folder_path)
+                if not entry.name.startswith('.') and entry.is_file()]
+
+    def stat_file(self, name):
+        stat = os.stat(os.path.join(self.folder_path, name))
+        return stat.st_size, stat.st_mtime
+
+    def compute_hash(self, name):
+        return hash_file(os.path.join(self.folder_path, name)).hexdigest()
+
+    def begin_upload(self, filename, meta):
+        validate_meta(meta)
+        os.makedirs(self.partial_path, exist_ok=True)
+        upload = PartialFileUpload(self, filename, meta)
+        return self.pipeline.wrap(upload) if self.pipeline is not None else upload
+
+    def open_download(self, filename):
+        return FileDownload(self, filename)
+
+    # Opens the partial file for an upload of some content, claiming the
+    # shared one if no other upload holds it. The claim is also a flock where
+    # the platform has one, which keeps out other worker processes.
+    #
+    # Returns:
+    #     tuple: (path, file opened for appending, True if the file is the
+    #     shared one and the claim has to be released)
+    def open_partial(self, sha256):
+        path = os.path.join(self.partial_path, sha256)
+        with self.claims_lock:
+            claimed = sha256 not in self.claims
+            if claimed:
+                self.claims.add(sha256)
+
+        if claimed:
+            file = open(path, 'ab')
+            try:
+                if fcntl is not None:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return path, file, True
+            except OSError:
+                file.close()
+                self.release_partial(sha256)
+
+        fd, path = tempfile.mkstemp(dir=self.partial_path, prefix=f'{sha256}.')
+        return path, os.fdopen(fd, 'ab'), False
+
+    def release_partial(self, sha256):
+        with self.claims_lock:
+            self.claims.discard(sha256)
+
+
+class PartialFileUpload:
+    def __init__(self, storage, filename, meta):
+        self.storage = storage
+        self.filename = filename
+        self.meta = meta
+
+        # Appending means a dropped connection leaves everything received so
+        # far on disk for the next attempt.
+        self.partial_path, self.file, self.claimed = storage.open_partial(meta['sha256'])
+        if self.claimed:
+            # An upload dropped between close and finish gives up its claim
+            # once it is collected.
+            self.release_claim = weakref.finalize(self, storage.release_partial, meta['sha256'])
+
+        offset = self.file.tell()
+        if offset > meta['size']:
+            self.file.truncate(0)
+            offset = 0
+
+        self.offset = offset
+        self.digest = hash_file(self.partial_path, offset) if offset else hashlib.sha256()
+        self.ranges = [[offset, meta['size'] - offset]] if offset < meta['size'] else []
+
+    def start_range(self, offset, length):
+        if offset != self.offset:
+            raise ProtocolError(f"Expected data from byte {self.offset}, got {offset}.")
+
+    def write(self, data):
+        self.file.write(data)
+        self.digest.update(data)
+        self.offset += len(data)
+
+    def end_range(self):
+        self.file.flush()
+
+    # A complete upload keeps the shared partial file open, and with it the
+    # claim, until finish has moved it into place; otherwise another upload of
+    # the same content could claim it in between.
+    def close(self):
+        if self.file is None:
+            return
+        if self.claimed and self.offset == self.meta['size']:
+            self.file.flush()
+        else:
+            self.release()
+
+    def release(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.claimed:
+            self.release_claim()
+
+    # Verifies the completed upload and atomically moves it into place.
+    #
+    # Returns:
+    #     str: An error message for the client, or None on success.
+    def finish(self):
+        try:
+            return self.store()
+        finally:
+            self.release()
+
+    def store(self):
+        if not os.path.exists(self.partial_path):
+            open(self.partial_path, 'wb').close()
+
+        size = os.path.getsize(self.partial_path)
+        if size < self.meta['size']:
+            if not self.claimed:
+                os.remove(self.partial_path)
+            return f"Error: Upload of {self.filename} is incomplete; send /store {self.filename} again to resume."
+
+        sha256 = self.digest.hexdigest()
+        if size != self.meta['size'] or sha256 != self.meta['sha256']:
+            os.remove(self.partial_path)
+            return f"Error: Checksum mismatch for {self.filename}; the upload was discarded."
+
+        self.storage.durability.sync(self.partial_path)
+        if fcntl is None and self.file is not None:
+            # There is no flock to keep, and Windows cannot rename an open file.
+            self.file.close()
+            self.file = None
+
+        file_path = os.path.join(self.storage.folder_path, self.filename)
+        with self.storage.names.hold(self.filename):
+            os.replace(self.partial_path, file_path)
+            self.storage.index.update(self.filename, size, os.stat(file_path).st_mtime, sha256)
+
+        self.storage.durability.sync(self.storage.folder_path)
+        return None
+
+
+class FileDownload:
+    def __init__(self, storage, filename):
+        self.file = open(os.path.join(storage.folder_path, filename), 'rb')
+        try:
+            self.size = os.fstat(self.file.fileno()).st_size
+            self.sha256 = storage.index.get_hash(filename)
+        except BaseException:
+            self.file.close()
+            raise
+
+    def segments(self, offset, length):
+        yield self.file, offset, length
+
+    def close(self):
+        self.file.close()
+
+
+# Content-addressed storage: files are split into CHUNK_SIZE chunks stored once
+# each as folder_path/.chunks/<sha256[:2]>/<sha256>, and every stored filename
+# has a manifest in folder_path/.manifests listing its chunks in order.
+#
+# Clients announce the sha256 of each chunk in their FILE_META, and only chunks
+# the server has never seen are requested and written. An interrupted upload
+# resumes for free, since the chunks that did arrive are already stored.
+class ChunkStorage:
+    def __init__(self, folder_path, durability='none', pipeline=None):
+        self.folder_path = folder_path
+        self.chunk_path = os.path.join(folder_path, '.chunks')
+        self.manifest_path = os.path.join(folder_path, '.manifests')
+        self.durability = Durability(durability)
+        self.pipeline = pipeline
+        self.names = NameLocks()
+        self.index = FileIndex(self)
+
+    def list_files(self):
+        if not os.path.exists(self.manifest_path):
+            return []
+        return [name[:-len('.json')] for name in os.listdir(self.manifest_path) if name.endswith('.json')]
+
+    def stat_file(self, name):
+        stat = os.stat(self.get_manifest_path(name))
+        return self.read_manifest(name)['size'], stat.st_mtime
+
+    def compute_hash(self, name):
+        return self.read_manifest(name)['sha256']
+
+    def get_chunk_path(self, sha256):
+        return os.path.join(self.chunk_path, sha256[:2], sha256)
+
+    def has_chunk(self, sha256):
+        return os.path.exists(self.get_chunk_path(sha256))
+
+    def get_manifest_path(self, filename):
+        return os.path.join(self.manifest_path, filename + '.json')
+
+    def read_manifest(self, filename):
+        with open(self.get_manifest_path(filename), 'rb') as file:
+            return json.loads(file.read().decode('utf-8'))
+
+    def begin_upload(self, filename, meta):
+        validate_meta(meta)
+
+        chunks = meta.get('chunks')
+        expected = (meta['size'] + CHUNK_SIZE - 1) // CHUNK_SIZE
+        if not isinstance(chunks, list) or len(chunks) != expected or not all(is_sha256(c) for c in chunks):
+            raise ProtocolError("Invalid chunk list in file metadata.")
+
+        os.makedirs(self.chunk_path, exist_ok=True)
+        os.makedirs(self.manifest_path, exist_ok=True)
+        upload = ChunkUpload(self, filename, meta)
+        return self.pipeline.wrap(upload) if self.pipeline is not None else upload
+
+    def open_download(self, filename):
+        try:
+            manifest = self.read_manifest(filename)
+        except (OSError, ValueError):
+            raise FileNotFoundError(filename)
+
+        return ChunkDownload(self, manifest)
+
+
+class ChunkUpload:
+    def __init__(self, storage, filename, meta):
+        self.storage = storage
+        self.filename = filename
+        self.meta = meta
+        self.chunks = meta['chunks']
+        self.file = None
+        self.temp_path = None
+        self.written_dirs = set()  # chunk directories to flush before the manifest is written
+
+        requested = set()
+        self.ranges = []
+        for index, sha256 in enumerate(self.chunks):
+            if sha256 not in requested and not storage.has_chunk(sha256):
+                offset = index * CHUNK_SIZE
+                self.ranges.append([offset, min(CHUNK_SIZE, meta['size'] - offset)])
+                requested.add(sha256)
+
+    def start_range(self, offset, length):
+        if offset % CHUNK_SIZE:
+            raise ProtocolError(f"Byte {offset} is not on a chunk boundary.")
+
+        self.expected = self.chunks[offset // CHUNK_SIZE]
+        self.digest = hashlib.sha256()
+        fd, self.temp_path = tempfile.mkstemp(dir=self.storage.chunk_path, prefix='.tmp-')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+        self.digest.update(data)
+
+    def end_range(self):
+        self.file.close()
+        self.file = None
+
+        if self.digest.hexdigest() != self.expected:
+            self.close()
+            raise ProtocolError(f"Chunk {self.expected} does not match its announced hash.")
+
+        self.storage.durability.sync(self.temp_path)
+
+        chunk_path = self.storage.get_chunk_path(self.expected)
+        os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+        os.replace(self.temp_path, chunk_path)
+        self.temp_path = None
+        self.written_dirs.add(os.path.dirname(chunk_path))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.temp_path is not None:
+            os.remove(self.temp_path)
+            self.temp_path = None
+
+    def finish(self):
+        missing = [c for c in self.chunks if not self.storage.has_chunk(c)]
+        if missing:
+            return f"Error: Upload of {self.filename} is incomplete; send /store {self.filename} again to resume."
+
+        # Chunks are verified one by one as they arrive, but the manifest also
+        # promises a whole-file sha256 to downloaders, so check that too.
+        digest = hashlib.sha256()
+        for sha256 in self.chunks:
+            hash_file(self.storage.get_chunk_path(sha256), digest=digest)
+        if digest.hexdigest() != self.meta['sha256']:
+            return f"Error: Checksum mismatch for {self.filename}; the upload was discarded."
+
+        self.storage.durability.sync(*sorted(self.written_dirs))
+
+        manifest = {'size': self.meta['size'], 'sha256': self.meta['sha256'], 'chunks': self.chunks}
+        manifest_path = self.storage.get_manifest_path(self.filename)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with self.storage.names.hold(self.filename):
+            write_atomically(manifest_path, json.dumps(manifest).encode('utf-8'), self.storage.durability)
+            self.storage.index.update(self.filename, self.meta['size'], os.stat(manifest_path).st_mtime,
+                                      self.meta['sha256'])
+
+        self.storage.durability.sync(os.path.dirname(manifest_path))
+        return None
+
+
+class ChunkDownload:
+    def __init__(self, storage, manifest):
+        self.storage = storage
+        self.size = manifest['size']
+        self.sha256 = manifest['sha256']
+        self.chunks = manifest['chunks']
+
+    def segments(self, offset, length):
+        end = offset + length
+
+        while offset < end:
+            index, start = divmod(offset, CHUNK_SIZE)
+            count = min(CHUNK_SIZE - start, end - offset)
+
+            with open(self.storage.get_chunk_path(self.chunks[index]), 'rb') as file:
+                yield file, start, count
+
+            offset += count
+
+    def close(self):
+        pass